@@ -0,0 +1,330 @@
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+import numpy as np
+import balancedtreefunctions as btf
+import boundingbox as bb
+import database as db
+import kdtree as kd
+import quadtree as qt
+
+try:
+	import scipy.spatial as sp
+except ImportError:
+	sp = None
+
+class Generators:
+	"""
+	Synthetic point sets in the unit square, every generator returns a
+	(n, 2) numpy array.
+
+	:Example:
+	>>> points = Generators.clusters(1000, np.random.default_rng(0))
+	"""
+	@staticmethod
+	def uniform(n, rng):
+		"""
+		Uniformly distributed points
+		"""
+		return rng.random((n, 2))
+
+	@staticmethod
+	def clusters(n, rng):
+		"""
+		Points drawn from 32 gaussian clusters with different spreads
+		"""
+		centers = rng.random((32, 2))
+		spread = rng.uniform(0.002, 0.05, 32)
+		cluster = rng.integers(0, 32, n)
+		return np.clip(centers[cluster] + rng.normal(0, 1, (n, 2)) * spread[cluster, np.newaxis], 0, 1)
+
+	@staticmethod
+	def duplicates(n, rng):
+		"""
+		Points on only ~sqrt(n) distinct locations, every location is
+		repeated many times
+		"""
+		locations = rng.random((max(int(np.sqrt(n)), 1), 2))
+		return locations[rng.integers(0, len(locations), n)]
+
+	@staticmethod
+	def line(n, rng):
+		"""
+		Points along a thin diagonal corridor, like a road or a coastline
+		"""
+		t = rng.random(n)
+		return np.column_stack((t, 0.2 + 0.6 * t + rng.normal(0, 0.002, n)))
+
+	GENERATORS = ["uniform", "clusters", "duplicates", "line"]
+
+class Benchmark:
+	"""
+	Measures the build time, the peak memory and the query latencies of the
+	Database, KDTree and PointQuadTree on the synthetic point sets, for every
+	combination of size and KDTree settings. scipy's cKDTree is measured on
+	the same data and queries as baseline (when scipy is installed).
+
+	Range queries are squares (centered on a data point) covering
+	selectivity of the unit square, so cKDTree answers them with a
+	query_ball_point in the infinity norm. Latencies are reported as
+	percentiles in milliseconds, peak memory in MB (tracemalloc, measured
+	in a second build because tracing slows the build down).
+
+	:Example:
+	>>> benchmark = Benchmark(["uniform"], [1000], [None], [32], queries = 100)
+	>>> results = benchmark.run()
+	>>> Benchmark.save(results, "benchmark.json")
+	"""
+	PERCENTILES = [50, 90, 99]
+
+	def __init__(self, datasets, sizes, max_depths, max_elements, queries = 200, k = 8, selectivity = 1e-4, seed = 0, memory = True):
+		"""
+		:param datasets		: names of Generators
+		:param sizes		: the amounts of points
+		:param max_depths	: the max-depth settings (None derives the depth
+							  from every max-elements setting)
+		:param max_elements	: the max-elements settings
+		:param queries		: the amount of queries per measurement
+		:param k			: the amount of neighbours for the closest queries
+		:param selectivity	: the area of the range queries
+		:param seed			: seed of the random generator
+		:param memory		: measure the peak memory
+		"""
+		self.datasets = datasets
+		self.sizes = sizes
+		self.max_depths = max_depths
+		self.max_elements = max_elements
+		self.queries = queries
+		self.k = k
+		self.selectivity = selectivity
+		self.seed = seed
+		self.memory = memory
+
+	@staticmethod
+	def latencies(function, queries):
+		"""
+		Calls function on every query and returns the latency percentiles
+		(and mean) in milliseconds.
+		"""
+		times = np.empty(len(queries))
+		for i, query in enumerate(queries):
+			start = time.perf_counter()
+			function(query)
+			times[i] = time.perf_counter() - start
+		times *= 1000.0
+		result = {"p%i" % p : float(np.percentile(times, p)) for p in Benchmark.PERCENTILES}
+		result["mean"] = float(np.mean(times))
+		return result
+
+	@staticmethod
+	def measure(function):
+		"""
+		Returns the result of function and its wall time in seconds.
+		"""
+		start = time.perf_counter()
+		result = function()
+		return result, time.perf_counter() - start
+
+	@staticmethod
+	def peak_memory(function):
+		"""
+		Returns the peak memory in MB allocated while running function.
+		"""
+		tracemalloc.start()
+		try:
+			function()
+			return tracemalloc.get_traced_memory()[1] / 2.0 ** 20
+		finally:
+			tracemalloc.stop()
+
+	def run(self):
+		"""
+		Runs all the measurements and returns a json serializable dictionary.
+		"""
+		results = {"meta" : Benchmark.environment(), "settings" : {"queries" : self.queries, "k" : self.k,
+				   "selectivity" : self.selectivity, "seed" : self.seed}, "results" : []}
+
+		for dataset in self.datasets:
+			for n in self.sizes:
+				rng = np.random.default_rng(self.seed)
+				points = getattr(Generators, dataset)(n, rng)
+				half = np.sqrt(self.selectivity) / 2.0
+				centers = points[rng.integers(0, n, self.queries)]
+				boxes = [bb.BoundingBox(x - half, x + half, y - half, y + half) for x, y in centers]
+				targets = rng.random((self.queries, 2))
+				# targets along a thin corridor, every target is close to long and narrow cells
+				corridor = Generators.line(self.queries, rng)
+
+				database, seconds = Benchmark.measure(lambda: Benchmark.database(points))
+				record = {"dataset" : dataset, "n" : n, "structure" : "Database", "build_s" : seconds}
+				if self.memory:
+					record["peak_mb"] = Benchmark.peak_memory(lambda: Benchmark.database(points))
+				record["where_ms"] = Benchmark.latencies(lambda box: database.where("x", "<", box.max_x), boxes[:10])
+				results["results"].append(record)
+				print(Benchmark.summary(record))
+
+				for max_depth in self.max_depths:
+					for max_elements in self.max_elements:
+						# the automatic depth of KDTree ignores max-elements, so derive it here
+						if max_depth is None:
+							depth = btf.BalancedTreeFunctions.tree_depth_max_leave_elements(n, max_elements)
+						else:
+							depth = max_depth
+						options = {"max-depth" : depth, "max-elements" : max_elements}
+						results["results"].append(self.run_kdtree(dataset, database, options, boxes, centers, targets, corridor))
+						print(Benchmark.summary(results["results"][-1]))
+
+				results["results"].append(self.run_quadtree(dataset, database, boxes))
+				print(Benchmark.summary(results["results"][-1]))
+
+				if sp is not None:
+					results["results"].append(self.run_ckdtree(dataset, points, half, centers, targets, corridor))
+					print(Benchmark.summary(results["results"][-1]))
+
+		return results
+
+	@staticmethod
+	def database(points):
+		"""
+		Returns a new Database holding points
+		"""
+		database = db.Database(["x", "y"])
+		database.insert_iterable(points)
+		return database
+
+	def run_kdtree(self, dataset, database, options, boxes, centers, targets, corridor):
+		"""
+		Measures a KDTree with the given options
+		"""
+		tree, seconds = Benchmark.measure(lambda: kd.KDTree(database, options))
+		record = {"dataset" : dataset, "n" : len(tree.keys), "structure" : "KDTree", "options" : options,
+				  "max_depth" : tree.max_depth, "build_s" : seconds}
+		if self.memory:
+			record["peak_mb"] = Benchmark.peak_memory(lambda: kd.KDTree(database, options))
+
+		record["rquery_ms"] = Benchmark.latencies(tree.rquery, boxes)
+		record["closest_ms"] = Benchmark.latencies(lambda point: tree.closest(point, self.k), targets)
+		record["closest_many_s"] = Benchmark.measure(lambda: tree.closest_many(targets, self.k))[1]
+		record["closest_many_line_s"] = Benchmark.measure(lambda: tree.closest_many(corridor, self.k))[1]
+		record["rquery_many_s"] = Benchmark.measure(lambda: tree.rquery_many(boxes, csr = True))[1]
+		return record
+
+	def run_quadtree(self, dataset, database, boxes):
+		"""
+		Measures a PointQuadTree
+		"""
+		depth = max(qt.QuadTree.level(max(len(database.keys()), 2)) // 2 + 1, 2)
+		tree, seconds = Benchmark.measure(lambda: qt.PointQuadTree(database, depth))
+		record = {"dataset" : dataset, "n" : len(database.keys()), "structure" : "PointQuadTree", "depth" : depth, "build_s" : seconds}
+		if self.memory:
+			record["peak_mb"] = Benchmark.peak_memory(lambda: qt.PointQuadTree(database, depth))
+		record["rquery_ms"] = Benchmark.latencies(tree.rquery, boxes)
+		return record
+
+	def run_ckdtree(self, dataset, points, half, centers, targets, corridor):
+		"""
+		Measures scipy's cKDTree as baseline
+		"""
+		tree, seconds = Benchmark.measure(lambda: sp.cKDTree(points))
+		record = {"dataset" : dataset, "n" : len(points), "structure" : "cKDTree", "build_s" : seconds}
+		if self.memory:
+			record["peak_mb"] = Benchmark.peak_memory(lambda: sp.cKDTree(points))
+		record["rquery_ms"] = Benchmark.latencies(lambda center: tree.query_ball_point(center, half, p=np.inf), centers)
+		record["closest_ms"] = Benchmark.latencies(lambda point: tree.query(point, self.k), targets)
+		record["closest_many_s"] = Benchmark.measure(lambda: tree.query(targets, self.k))[1]
+		record["closest_many_line_s"] = Benchmark.measure(lambda: tree.query(corridor, self.k))[1]
+		return record
+
+	@staticmethod
+	def summary(record):
+		"""
+		Returns a single line describing a result
+		"""
+		line = "%-10s %9i %-13s build %8.3fs" % (record["dataset"], record["n"], record["structure"], record["build_s"])
+		if "options" in record:
+			line += " depth %2i elements %5i" % (record["max_depth"], record["options"]["max-elements"])
+		for name in ("rquery_ms", "closest_ms"):
+			if name in record:
+				line += " %s p50 %.3f p99 %.3f" % (name.split("_")[0], record[name]["p50"], record[name]["p99"])
+		return line
+
+	@staticmethod
+	def environment():
+		"""
+		Returns a description of the machine and library versions
+		"""
+		return {"python" : platform.python_version(), "numpy" : np.__version__, "machine" : platform.machine(),
+				"processor" : platform.processor(), "time" : time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+	@staticmethod
+	def save(results, path):
+		"""
+		Writes the results as json
+		"""
+		with open(path, "w") as f:
+			json.dump(results, f, indent=1)
+
+	@staticmethod
+	def compare(results, path, threshold = 1.2):
+		"""
+		Compares results with the results stored in path (of an older
+		version), returns the lines of the measurements that became more
+		than threshold times slower.
+
+		:Example:
+		>>> for line in Benchmark.compare(results, "old.json"):
+		>>>		print(line)
+		<<< uniform 100000 KDTree {"max-depth": 13, "max-elements": 32} rquery_ms.p50 0.410 -> 0.650
+		"""
+		with open(path) as f:
+			old = json.load(f)
+
+		key = lambda record: (record["dataset"], record["n"], record["structure"], json.dumps(record.get("options"), sort_keys=True))
+		previous = {key(record) : record for record in old["results"]}
+		lines = []
+		for record in results["results"]:
+			before = previous.get(key(record))
+			if before is None:
+				continue
+			for name, value in record.items():
+				if name.endswith(("_s", "_ms", "_mb")) and name in before:
+					values = value if isinstance(value, dict) else {"" : value}
+					for stat, now in values.items():
+						then = before[name][stat] if stat else before[name]
+						if then > 0 and now > threshold * then:
+							lines.append("%s %i %s %s %s%s %.3f -> %.3f" % (record["dataset"], record["n"], record["structure"],
+										 json.dumps(record.get("options")), name, "." + stat if stat else "", then, now))
+		return lines
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description = 'Database, KDTree and QuadTree benchmarks.')
+
+	parser.add_argument('--datasets', help='comma separated generators (%s).' % ",".join(Generators.GENERATORS),type=str,default=",".join(Generators.GENERATORS))
+	parser.add_argument('--sizes', help='comma separated amounts of points, up to 10000000.',type=str,default="1000,10000,100000")
+	parser.add_argument('--max-depth', help='comma separated max-depth settings, auto derives the depth from every max-elements setting.',type=str,default="auto")
+	parser.add_argument('--max-elements', help='comma separated max-elements settings.',type=str,default="16,128")
+	parser.add_argument('--queries', help='the amount of queries per measurement.',type=int,default=200)
+	parser.add_argument('--k', help='the amount of neighbours of the closest queries.',type=int,default=8)
+	parser.add_argument('--selectivity', help='the area of the range queries.',type=float,default=1e-4)
+	parser.add_argument('--seed', help='seed of the random generator.',type=int,default=0)
+	parser.add_argument('--no-memory', help='skip the peak memory measurements.',action='store_true')
+	parser.add_argument('--output', help='json file for the results.',type=str,default="benchmark.json")
+	parser.add_argument('--compare', help='json file of an older run, slower measurements are reported.',type=str)
+	parser.add_argument('--threshold', help='the slowdown that is reported by --compare.',type=float,default=1.2)
+
+	args = parser.parse_args()
+
+	benchmark = Benchmark(args.datasets.split(","), [int(float(n)) for n in args.sizes.split(",")],
+						  [None if depth == "auto" else int(depth) for depth in args.max_depth.split(",")],
+						  [int(elements) for elements in args.max_elements.split(",")],
+						  args.queries, args.k, args.selectivity, args.seed, not args.no_memory)
+	results = benchmark.run()
+	Benchmark.save(results, args.output)
+
+	if args.compare:
+		for line in Benchmark.compare(results, args.compare, args.threshold):
+			print("slower: " + line)
@@ -0,0 +1,113 @@
+import json
+import os
+import struct
+import numpy as np
+
+class BinaryFile:
+	"""
+	A minimal versioned binary file format for storing a set of named numpy
+	arrays, laid out so they can be memory-mapped.
+
+	layout:
+		magic		: 8 bytes identifying the content (e.g. b"INFODB\0\0")
+		version		: uint32 (little endian)
+		length		: uint32, length of the header
+		header		: utf-8 json {"meta": {...}, "arrays": [{name, dtype, shape, offset}]}
+		arrays		: every array contiguous, aligned on ALIGNMENT bytes, the
+					  offsets in the header are relative to the first array
+
+	:Example:
+	>>> BinaryFile.write("data.bin", b"EXAMPLE\0", {"rows": 2}, [("x", np.array([1., 2.]))])
+	>>> meta, arrays = BinaryFile.read("data.bin", b"EXAMPLE\0")
+	>>> print(meta, arrays["x"])
+	<<< {'rows': 2} [1. 2.]
+	"""
+	VERSION = 1
+	ALIGNMENT = 64
+	PREFIX = struct.Struct("<8sII")
+
+	@staticmethod
+	def align(offset):
+		"""
+		Returns the first aligned offset >= offset
+		"""
+		return -(-offset // BinaryFile.ALIGNMENT) * BinaryFile.ALIGNMENT
+
+	@staticmethod
+	def write(path, magic, meta, arrays):
+		"""
+		Writes the (name, array) pairs and the json serializable meta
+		dictionary to path. The file is written next to path first and
+		then moved into place, so files that are still memory-mapped by
+		readers are never overwritten.
+
+		:param path		: the file name
+		:param magic	: 8 bytes identifying the content
+		:param meta		: dictionary with additional information
+		:param arrays	: a list of (name, numpy array) pairs
+		"""
+		arrays = [(name, np.ascontiguousarray(array)) for name, array in arrays]
+
+		descriptions = []
+		offset = 0
+		for name, array in arrays:
+			offset = BinaryFile.align(offset)
+			descriptions.append({"name" : name, "dtype" : array.dtype.str, "shape" : list(array.shape), "offset" : offset})
+			offset += array.nbytes
+
+		header = json.dumps({"meta" : meta, "arrays" : descriptions}).encode("utf-8")
+		data_start = BinaryFile.align(BinaryFile.PREFIX.size + len(header))
+
+		tmp = path + ".tmp"
+		with open(tmp, "wb") as f:
+			f.write(BinaryFile.PREFIX.pack(magic, BinaryFile.VERSION, len(header)))
+			f.write(header)
+			for (name, array), description in zip(arrays, descriptions):
+				f.write(b"\0" * (data_start + description["offset"] - f.tell()))
+				f.write(memoryview(array.reshape(-1)).cast("B"))
+		os.replace(tmp, path)
+
+	@staticmethod
+	def read(path, magic, mmap = True):
+		"""
+		Reads a file written by write, returns the meta dictionary and a
+		dictionary of arrays. With mmap the arrays are copy-on-write memory
+		maps, only the pages that are touched are loaded and unmodified pages
+		are shared between processes, changes are never written back.
+
+		:param path	: the file name
+		:param magic: the expected 8 bytes identifying the content
+		:param mmap	: memory-map the arrays instead of reading them
+		"""
+		with open(path, "rb") as f:
+			file_magic, version, length = BinaryFile.PREFIX.unpack(f.read(BinaryFile.PREFIX.size))
+			if file_magic != magic:
+				raise ValueError('%s is not a %r file.' % (path, magic))
+			if version > BinaryFile.VERSION:
+				raise ValueError('%s has an unsupported version %i.' % (path, version))
+			header = json.loads(f.read(length).decode("utf-8"))
+
+		data_start = BinaryFile.align(BinaryFile.PREFIX.size + length)
+
+		arrays = {}
+		for description in header["arrays"]:
+			dtype = np.dtype(description["dtype"])
+			shape = tuple(description["shape"])
+			offset = data_start + description["offset"]
+			count = int(np.prod(shape))
+
+			if count == 0:
+				arrays[description["name"]] = np.zeros(shape, dtype)
+			elif mmap:
+				arrays[description["name"]] = np.memmap(path, dtype, "c", offset, shape)
+			else:
+				arrays[description["name"]] = np.fromfile(path, dtype, count, offset=offset).reshape(shape)
+
+		return header["meta"], arrays
+
+if __name__ == '__main__':
+
+	BinaryFile.write("example.bin", b"EXAMPLE\0", {"rows": 2}, [("x", np.array([1., 2.])), ("k", np.arange(3))])
+	meta, arrays = BinaryFile.read("example.bin", b"EXAMPLE\0")
+	print(meta, arrays["x"], arrays["k"])
+	os.remove("example.bin")
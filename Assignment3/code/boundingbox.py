@@ -6,8 +6,15 @@ class BoundingBox:
 	This class allows the user to be more flexible in case where bbox reductions
 	induced by recursive algorithms.
 
+	The sides are stored as plain floats (min_x, max_x, min_y, max_y), so
+	the many boxes created while traversing a tree are cheap. The data
+	property returns them as a [[min_x, max_x], [min_y, max_y]] numpy array,
+	changing that array does not change the bbox.
+
 	NOTICE the class does not test for invalid bboxes, (x_max < x_min)
 	"""
+	__slots__ = ("min_x", "max_x", "min_y", "max_y")
+
 	def __init__(self, min_x, max_x, min_y, max_y):
 		"""
 		Creates a BoundingBox
@@ -20,7 +27,30 @@ class BoundingBox:
 		:Example:
 		>>> BoundingBox(0,1,2,4)
 		"""
-		self.data = np.array([[min_x, max_x],[ min_y, max_y]],np.float)
+		self.min_x = float(min_x)
+		self.max_x = float(max_x)
+		self.min_y = float(min_y)
+		self.max_y = float(max_y)
+
+	@property
+	def data(self):
+		"""
+		Returns the bbox as a [[min_x, max_x], [min_y, max_y]] numpy array
+		:Example:
+		>>> print(bbox.data)
+		<<< [[0. 1.]
+			 [2. 4.]]
+		"""
+		return np.array([[self.min_x, self.max_x], [self.min_y, self.max_y]])
+
+	def side(self, axis):
+		"""
+		Returns the (minimum, maximum) tuple of an axis
+		:Example:
+		>>> print(bbox.side(1))
+		<<< (2.0, 4.0)
+		"""
+		return (self.min_x, self.max_x) if axis == 0 else (self.min_y, self.max_y)
 
 	def lower_left(self):
 		"""
@@ -29,7 +59,7 @@ class BoundingBox:
 		>>> print(bbox.lower_left())
 		<<< (0.0, 2.0)
 		"""
-		return (self.data[0,0],self.data[1,0])
+		return (self.min_x, self.min_y)
 
 	def width(self):
 		"""
@@ -38,7 +68,7 @@ class BoundingBox:
 		>>> print(bbox.width())
 		<<< 1.0
 		"""
-		return self.data[0,1] - self.data[0,0]
+		return self.max_x - self.min_x
 	
 	def height(self):
 		"""
@@ -47,7 +77,7 @@ class BoundingBox:
 		>>> print(bbox.height())
 		<<< 2.0
 		"""
-		return self.data[1,1] - self.data[1,0]
+		return self.max_y - self.min_y
 
 	def within(self,value, axis):
 		"""
@@ -58,8 +88,45 @@ class BoundingBox:
 		>>> print(bbox.within(3,1))
 		<<< True	
 		""" 
-		ax = self.data[axis,:]
-		return ax[0]<= value and value <= ax[1]
+		low, high = self.side(axis)
+		return low <= value and value <= high
+
+	def within_points(self, points):
+		"""
+		Tests for every point in a (n, 2) matrix wheter it is within/touches
+		the boundingbox, returns a boolean mask.
+
+		:Example:
+		>>> print(bbox.within_points(np.array([[0.5, 3], [2, 3]])))
+		<<< [ True False]
+		"""
+		points = np.asarray(points)
+		return ((self.min_x <= points[:,0]) & (points[:,0] <= self.max_x) &
+				(self.min_y <= points[:,1]) & (points[:,1] <= self.max_y))
+
+	def contains(self, bbox):
+		"""
+		Tests wheter the given BoundingBox lies completely inside
+		(or touches the sides of) this boundingbox.
+
+		:Example:
+		>>> print(bbox.contains(BoundingBox(0.2,0.5,2,3)))
+		<<< True
+		"""
+		return (self.min_x <= bbox.min_x and bbox.max_x <= self.max_x and
+				self.min_y <= bbox.min_y and bbox.max_y <= self.max_y)
+
+	def intersects(self, bbox):
+		"""
+		Tests wheter the given BoundingBox overlaps or touches
+		this boundingbox.
+
+		:Example:
+		>>> print(bbox.intersects(BoundingBox(0.5,3,3,5)))
+		<<< True
+		"""
+		return (self.min_x <= bbox.max_x and bbox.min_x <= self.max_x and
+				self.min_y <= bbox.max_y and bbox.min_y <= self.max_y)
 
 	def partition(self,value, axis):
 		"""
@@ -76,7 +143,8 @@ class BoundingBox:
 		>>> print(bbox.partition(5,1))
 		<<< (True, False)	
 		""" 
-		return (self.data[axis,0] <= value, value <= self.data[axis,1])
+		low, high = self.side(axis)
+		return (low <= value, value <= high)
 
 	def reduce_min(self,axis, value):
 		"""
@@ -88,9 +156,9 @@ class BoundingBox:
 		<<< [[ 0.3  1. ]
  			 [ 2.   4. ]]
 		""" 
-		bb = BoundingBox.from_matrix(self.data)
-		bb.data[axis,0] = value
-		return bb
+		if axis == 0:
+			return BoundingBox(value, self.max_x, self.min_y, self.max_y)
+		return BoundingBox(self.min_x, self.max_x, value, self.max_y)
 
 	def reduce_max(self,axis, value):
 		"""
@@ -102,9 +170,9 @@ class BoundingBox:
 		<<< [[ 0.  0.3 ]
  			 [ 2.  4. ]]
 		""" 
-		bb = BoundingBox.from_matrix(self.data)
-		bb.data[axis,1] = value
-		return bb
+		if axis == 0:
+			return BoundingBox(self.min_x, value, self.min_y, self.max_y)
+		return BoundingBox(self.min_x, self.max_x, self.min_y, value)
 
 	def reduce_min_by(self,axis, value):
 		"""
@@ -116,9 +184,7 @@ class BoundingBox:
 		<<< [[ 0.3  1. ]
 			 [ 2.   4. ]]
 		""" 
-		bb = BoundingBox.from_matrix(self.data)
-		bb.data[axis,0] += value
-		return bb
+		return self.reduce_min(axis, self.side(axis)[0] + value)
 
 	def reduce_max_by(self,axis, value):
 		"""
@@ -130,9 +196,22 @@ class BoundingBox:
 		<<< [[ 0.   0.7]
  			 [ 2.   4. ]]
 		""" 
-		bb = BoundingBox.from_matrix(self.data)
-		bb.data[axis,1] -= value
-		return bb
+		return self.reduce_max(axis, self.side(axis)[1] - value)
+
+	def distance(self, points):
+		"""
+		Returns the (euclidean) distance between the given point(s) and the
+		closest side of the bbox, points inside/touching the bbox have a
+		distance of 0. Accepts a single point or a (n, 2) matrix of points.
+
+		:Example:
+		>>> print(bbox.distance([4, 6]))
+		<<< 3.60555127546
+		"""
+		points = np.asarray(points, dtype=np.float64)
+		dx = np.maximum(np.maximum(self.min_x - points[...,0], points[...,0] - self.max_x), 0)
+		dy = np.maximum(np.maximum(self.min_y - points[...,1], points[...,1] - self.max_y), 0)
+		return np.sqrt(dx * dx + dy * dy)
 
 	def centroid(self):
 		"""
@@ -143,7 +222,7 @@ class BoundingBox:
 		<<< [0.5, 3.0]
 
 		""" 
-		return [self.data[0,0] + self.width() / 2.0, self.data[1,0] + self.height() / 2.0]
+		return [(self.min_x + self.max_x) / 2.0, (self.min_y + self.max_y) / 2.0]
 
 	def __str__(self):
 		"""
@@ -189,6 +268,184 @@ class BoundingBox:
 
 		return BoundingBox(minx,maxx,miny,maxy)
 
+class BoundingBoxArray:
+	"""
+	A collection of N bounding boxes stored in a single (N, 4) numpy array,
+	the columns are min_x, max_x, min_y, max_y (the order of the
+	BoundingBox constructor). Every operation works on all boxes at once.
+
+	:Example:
+	>>> boxes = BoundingBoxArray([[0, 1, 2, 4], [1, 3, 0, 1]])
+	>>> print(boxes.area())
+	<<< [2. 2.]
+	>>> print(boxes[1])
+	<<< [[1. 3.]
+		 [0. 1.]]
+	"""
+	def __init__(self, data):
+		"""
+		Creates a BoundingBoxArray from a (N, 4) array
+
+		:param data: (N, 4) array with the columns min_x, max_x, min_y, max_y
+		"""
+		self.data = np.asarray(data, dtype=np.float64).reshape(-1, 4)
+
+	def __len__(self):
+		return len(self.data)
+
+	def __getitem__(self, index):
+		"""
+		Returns a single BoundingBox for an integer index, otherwise
+		(slices, masks, index arrays) a BoundingBoxArray.
+		"""
+		if isinstance(index, (int, np.integer)):
+			return BoundingBox(*self.data[index])
+		return BoundingBoxArray(self.data[index])
+
+	def __iter__(self):
+		for row in self.data:
+			yield BoundingBox(*row)
+
+	def lower_left(self):
+		"""
+		Returns the lower left corners as a (N, 2) array
+		"""
+		return self.data[:, [0, 2]]
+
+	def width(self):
+		"""
+		Returns the widths as a (N,) array
+		"""
+		return self.data[:, 1] - self.data[:, 0]
+
+	def height(self):
+		"""
+		Returns the heights as a (N,) array
+		"""
+		return self.data[:, 3] - self.data[:, 2]
+
+	def area(self):
+		"""
+		Returns the areas as a (N,) array
+
+		:Example:
+		>>> print(boxes.area())
+		<<< [2. 2.]
+		"""
+		return self.width() * self.height()
+
+	def centroid(self):
+		"""
+		Returns the centers as a (N, 2) array
+
+		:Example:
+		>>> print(boxes.centroid())
+		<<< [[0.5 3. ]
+			 [2.  0.5]]
+		"""
+		return np.column_stack(((self.data[:, 0] + self.data[:, 1]) / 2.0, (self.data[:, 2] + self.data[:, 3]) / 2.0))
+
+	def contains_points(self, points):
+		"""
+		Tests for every box and every point of a (m, 2) matrix wheter the
+		point is within/touches the box, returns a (N, m) boolean matrix.
+
+		:Example:
+		>>> print(boxes.contains_points([[0.5, 3], [2, 0]]))
+		<<< [[ True False]
+			 [False  True]]
+		"""
+		points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+		x, y = points[np.newaxis, :, 0], points[np.newaxis, :, 1]
+		d = self.data[:, :, np.newaxis]
+		return (d[:, 0] <= x) & (x <= d[:, 1]) & (d[:, 2] <= y) & (y <= d[:, 3])
+
+	def intersects(self, bbox):
+		"""
+		Tests wheter the boxes overlap or touch a BoundingBox, returning
+		a (N,) boolean mask, or every box of another BoundingBoxArray,
+		returning a (N, M) boolean matrix.
+
+		:Example:
+		>>> print(boxes.intersects(BoundingBox(0.5,3,3,5)))
+		<<< [ True False]
+		"""
+		if isinstance(bbox, BoundingBox):
+			other = np.array([[bbox.min_x, bbox.max_x, bbox.min_y, bbox.max_y]])
+		else:
+			other = bbox.data
+		d = self.data[:, :, np.newaxis]
+		o = other.T[np.newaxis]
+		result = (d[:, 0] <= o[:, 1]) & (o[:, 0] <= d[:, 1]) & (d[:, 2] <= o[:, 3]) & (o[:, 2] <= d[:, 3])
+		return result[:, 0] if isinstance(bbox, BoundingBox) else result
+
+	def reduce_min(self, axis, values):
+		"""
+		Returns a BoundingBoxArray where the minimum side of an axis is
+		replaced by values, axis and values are scalars or (N,) arrays.
+
+		:Example:
+		>>> print(boxes.reduce_min(0, [0.5, 2]).data)
+		<<< [[0.5 1.  2.  4. ]
+			 [2.  3.  0.  1. ]]
+		"""
+		data = self.data.copy()
+		data[np.arange(len(data)), 2 * np.asarray(axis)] = values
+		return BoundingBoxArray(data)
+
+	def reduce_max(self, axis, values):
+		"""
+		Returns a BoundingBoxArray where the maximum side of an axis is
+		replaced by values, axis and values are scalars or (N,) arrays.
+
+		:Example:
+		>>> print(boxes.reduce_max(1, 3).data)
+		<<< [[0. 1. 2. 3.]
+			 [1. 3. 0. 3.]]
+		"""
+		data = self.data.copy()
+		data[np.arange(len(data)), 2 * np.asarray(axis) + 1] = values
+		return BoundingBoxArray(data)
+
+	def union(self):
+		"""
+		Returns the BoundingBox around all the boxes
+
+		:Example:
+		>>> print(boxes.union())
+		<<< [[0. 3.]
+			 [0. 4.]]
+		"""
+		return BoundingBox(self.data[:, 0].min(), self.data[:, 1].max(), self.data[:, 2].min(), self.data[:, 3].max())
+
+	def matrices(self):
+		"""
+		Returns the boxes as a (N, 2, 2) array, every box stored like
+		BoundingBox.data
+		"""
+		return self.data.reshape(-1, 2, 2)
+
+	def __str__(self):
+		return str(self.data)
+
+	@staticmethod
+	def from_boxes(boxes):
+		"""
+		Creates a BoundingBoxArray from a list of BoundingBoxes
+
+		:Example:
+		>>> boxes = BoundingBoxArray.from_boxes([BoundingBox(0,1,2,4)])
+		"""
+		return BoundingBoxArray([[b.min_x, b.max_x, b.min_y, b.max_y] for b in boxes])
+
+	@staticmethod
+	def from_matrices(matrices):
+		"""
+		Creates a BoundingBoxArray from a (N, 2, 2) array, every box
+		stored like BoundingBox.data
+		"""
+		return BoundingBoxArray(np.asarray(matrices, dtype=np.float64).reshape(-1, 4))
+
 if __name__ == '__main__':
 
 	bbox = BoundingBox(0,1,2,4)
@@ -196,11 +453,15 @@ if __name__ == '__main__':
 	print(bbox.width())
 	print(bbox.height())
 	print(bbox.within(3,1))
+	print(bbox.within_points(np.array([[0.5, 3], [2, 3]])))
+	print(bbox.contains(BoundingBox(0.2,0.5,2,3)))
+	print(bbox.intersects(BoundingBox(0.5,3,3,5)))
 	print(bbox.partition(5,1))
 	print(bbox.reduce_min(0,0.3))
 	print(bbox.reduce_max(0,0.3))
 	print(bbox.reduce_min_by(0,0.3))
 	print(bbox.reduce_max_by(0,0.3))
+	print(bbox.distance([4, 6]))
 	print(bbox.centroid())
 	print(bbox)
 	print(BoundingBox.from_matrix(np.array([[0, 1],[ 2, 4]])))
@@ -208,6 +469,16 @@ if __name__ == '__main__':
 	data = np.array([[0, 1],[0.5,3],[ 2, 4]])
 	print(data)
 	print(BoundingBox.from_dataset(data,0,1))
+
+	boxes = BoundingBoxArray([[0, 1, 2, 4], [1, 3, 0, 1]])
+	print(boxes.area())
+	print(boxes.centroid())
+	print(boxes.contains_points([[0.5, 3], [2, 0]]))
+	print(boxes.intersects(BoundingBox(0.5,3,3,5)))
+	print(boxes.reduce_min(0, [0.5, 2]))
+	print(boxes.reduce_max(1, 3))
+	print(boxes.union())
+	print(boxes[1])
 	
 
 
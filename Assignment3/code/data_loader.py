@@ -1,18 +1,18 @@
 import os
-from osgeo import ogr
+import shapereader as sr
 
 class DataLoader:
 	
-	def load_shape_file(self,filename, database):
-
-		shapefile = filename
-		driver = ogr.GetDriverByName("ESRI Shapefile")
-		dataSource = driver.Open(shapefile, 0)
-		layer = dataSource.GetLayer()
-	
-		for feature in layer:
-			center = feature.GetGeometryRef().Centroid()
-			database.insert([center.GetX(), center.GetY()])
+	def load_shape_file(self,filename, database, block_size = 65536):
+		"""
+		Loads the centroids of the shapes in a shapefile into the database,
+		the file is read in blocks of block_size records which are inserted
+		in bulk, see shapereader.ShapeReader.
+		"""
+		with sr.ShapeReader(filename) as shapes:
+			database.reserve(database.size + len(shapes))
+			for block in shapes.blocks(block_size):
+				database.insert_iterable(block)
 
 	def load_wiki_example_data(self,database):
 		data = [[2,3], [5,4], [9,6], [4,7], [8,1], [7,2]]
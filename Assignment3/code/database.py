@@ -1,160 +1,636 @@
+import collections
+import itertools
+import os
+import numpy as np
+import binaryfile as bf
+import secondaryindex as si
+
 class Database:
 	"""
-	An minimal database implementation, with the focus on storing 
-	matrices.	
+	An minimal database implementation, with the focus on storing
+	matrices.
+
+	The records are stored column wise, every field has its own growable
+	typed numpy array (key: int64, fields: float64 unless specified otherwise).
+	Rows are appended at the end, so the key column is always sorted.
+	Deleted rows are marked in a tombstone bitmap (allocated on the first
+	delete) and skipped by all lookups until compact reclaims them.
 	"""
-	def __init__(self, fields):
+	MAGIC = b"INFODB\0\0"
+
+	def __init__(self, fields, dtypes = {}):
 		"""
 		Create a new Database instance.
 		:param fields: a list containing the field names
+		:param dtypes: optional dictionary mapping a field name on a numpy dtype
 
 		:Example:
 		>>> db = Database(["x","y","quad-lvl"])
+		>>> db = Database(["x","y","quad-lvl"], {"x": np.float32, "y": np.float32})
 		"""
-		self.db = {}
 		self.fields_ = {"key" : 0}
 		for field in fields:
 			self.fields_[field] = len(self.fields_)
 
+		self.dtypes_ = {"key" : np.dtype(np.int64)}
+		for field in fields:
+			self.dtypes_[field] = np.dtype(dtypes.get(field, np.float64))
+
+		self.columns_ = {}
+		for field, dtype in self.dtypes_.items():
+			self.columns_[field] = np.zeros(0, dtype)
+
+		self.size = 0
 		self.unique_key = 0
-		self.num_fields = len(self.fields_) - 1 
-	
+		self.num_fields = len(self.fields_) - 1
+
+		self.tombstones = None
+		self.num_deleted = 0
+		self.deletions = 0
+		self.deleted_keys = collections.deque()
+		self.deleted_first = 0
+		self.num_logged = 0
+		self.versions = dict.fromkeys(self.fields_, 0)
+
+		self.indexes = {}
+
 	def fields(self):
 		"""
 		Returns the Database's field list
-		
+
 		:Example:
 		>>> db.fields()
 		<<< {'key': 0, 'quad-lvl': 3, 'x': 1, 'y': 2}
 		"""
 		return self.fields_
-		
+
+	def version(self, fields = None):
+		"""
+		Returns a counter that increases with every write (insert, update,
+		delete or compact) touching one of the given fields (default all
+		fields), used to invalidate results derived from those fields.
+
+		:param fields: optional collection of field names
+
+		:Example:
+		>>> v = db.version(["x","y"])
+		>>> db.update_field(1,"quad-lvl",2)
+		>>> print(db.version(["x","y"]) == v)
+		<<< True
+		"""
+		if fields is None:
+			fields = self.fields_
+		return self.versions["key"] + sum(self.versions[field] for field in fields if field != "key")
+
+	def changed(self, field = "key"):
+		"""
+		Internal method that bumps the version of a field, writes that add or
+		remove records bump the key, which counts for every field.
+		"""
+		self.versions[field] += 1
+
+	def reserve(self, size):
+		"""
+		Makes sure the columns can hold at least size records, the
+		capacity is at least doubled when growing to keep appending
+		amortized O(1).
+
+		:Example:
+		>>> db.reserve(1000)
+		"""
+		capacity = len(self.columns_["key"])
+		if size <= capacity:
+			return
+
+		capacity = max(size, 2 * capacity, 16)
+		for field, column in self.columns_.items():
+			grown = np.zeros(capacity, column.dtype)
+			grown[:self.size] = column[:self.size]
+			self.columns_[field] = grown
+
+		if self.tombstones is not None:
+			grown = np.zeros(capacity, bool)
+			grown[:self.size] = self.tombstones[:self.size]
+			self.tombstones = grown
 
 	def insert(self,record):
 		"""
 		Insert's a record into the database and return's
-		unique key.
-		
+		unique key. Missing trailing fields are set to 0.
+
 		:param record: a list containing the fields value in order
-											
+
 
 		:Example:
 		>>> print(db.insert([1,2]))
 		<<< 1
-	
+
 		>>> print(db.insert([1,2,3]))
 		<<< 2
 		"""
 		if len(record) > self.num_fields:
 			raise ValueError('This record contains has invalid length.')
-		
-		record.extend([0 for x in range(self.num_fields - len(record))])
 
-		self.unique_key += 1	
-		record.insert(0,self.unique_key)	
-		self.db[self.unique_key] = record
-		
+		self.reserve(self.size + 1)
+
+		self.unique_key += 1
+		row = self.size
+		self.columns_["key"][row] = self.unique_key
+		for field, index in self.fields_.items():
+			if index > 0:
+				self.columns_[field][row] = record[index - 1] if index <= len(record) else 0
+
+		self.size += 1
+		self.changed()
 		return self.unique_key
 
 	def insert_iterable(self, records):
 		"""
 		Inserts a record collection into the database and return's
-		the corresponding list of unique keys.
-		
-		:param record: a collection of records, see insert(self,record)
-											
+		the corresponding array of unique keys.
+
+		:param record: a collection of records, see insert(self,record), or
+					   a (n, m) numpy matrix with m <= the amount of fields
+
 		:Example:
 		>>> print(db.insert_iterable([[2,3],[3,4,5]]))
-		<<< [3, 4]
+		<<< [3 4]
+
+		>>> print(db.insert_iterable(np.array([[1,2],[3,4]])))
+		<<< [5 6]
+		"""
+		if not isinstance(records, np.ndarray):
+			records = list(records)
+			if len(set(len(record) for record in records)) > 1:
+				return np.array([self.insert(record) for record in records], dtype=np.int64)
+			records = np.asarray(records)
+
+		if records.ndim != 2 or records.shape[1] > self.num_fields:
+			if len(records) > 0:
+				raise ValueError('This record collection has an invalid shape.')
+			return np.array([], dtype=np.int64)
+
+		count = len(records)
+		self.reserve(self.size + count)
+
+		keys = np.arange(self.unique_key + 1, self.unique_key + count + 1, dtype=np.int64)
+		rows = slice(self.size, self.size + count)
+		self.columns_["key"][rows] = keys
+		for field, index in self.fields_.items():
+			if index > 0:
+				self.columns_[field][rows] = records[:, index - 1] if index <= records.shape[1] else 0
+
+		self.unique_key += count
+		self.size += count
+		self.changed()
+		return keys
+
+	def locate(self, keys):
+		"""
+		Internal method that returns the candidate row of every key and
+		a boolean mask telling which keys are in the database (and not
+		deleted).
+		"""
+		keys = np.asarray(keys, dtype=np.int64).reshape(-1)
+		if self.size == 0:
+			return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+
+		column = self.columns_["key"][:self.size]
+		rows = np.minimum(np.searchsorted(column, keys), self.size - 1)
+		found = column[rows] == keys
+		if self.num_deleted > 0:
+			found &= ~self.tombstones[rows]
+		return rows, found
+
+	def rows(self, keys):
+		"""
+		Returns the row positions of the given keys, keys that are not
+		in the database (or deleted) are left out.
+
+		:param keys: a collection of keys
+
+		:Example:
+		>>> db.rows([2, 4, 10])
+		<<< [1 3]
+		"""
+		rows, found = self.locate(keys)
+		return rows[found]
+
+	def contains(self, keys):
+		"""
+		Returns a boolean mask telling for every key wheter it is
+		in the database (and not deleted).
+
+		:param keys: a collection of keys
+
+		:Example:
+		>>> db.contains([2, 4, 10])
+		<<< [ True  True False]
+		"""
+		return self.locate(keys)[1]
+
+	def delete(self, keys):
+		"""
+		Deletes records by marking their rows in the tombstone bitmap,
+		the space is reclaimed by compact. The deleted keys are logged per
+		call, see deleted_since, the log keeps the last max(65536, n / 8)
+		keys. Returns the amount of records that were deleted.
+
+		:param keys: a collection or a single key
+
+		:Example:
+		>>> print(db.delete([3, 10]))
+		<<< 1
+		"""
+		rows = self.rows(keys)
+		if len(rows) == 0:
+			return 0
+
+		if self.tombstones is None:
+			self.tombstones = np.zeros(len(self.columns_["key"]), bool)
+
+		rows = np.unique(rows)
+		self.tombstones[rows] = True
+		self.num_deleted += len(rows)
+		self.deletions += 1
+		self.deleted_keys.append(self.columns_["key"][rows])
+		self.num_logged += len(rows)
+		while self.num_logged > max(65536, self.size // 8):
+			self.num_logged -= len(self.deleted_keys.popleft())
+			self.deleted_first += 1
+		self.changed()
+		return len(rows)
+
+	def deleted_since(self, deletions):
+		"""
+		Returns the keys deleted by the delete calls after the deletions
+		counter had the given value, so structures on the Database only
+		need to process the keys deleted since they last looked. Returns
+		None when the log no longer reaches back that far, the caller then
+		has to check its keys with contains.
+
+		:param deletions: an earlier value of the deletions counter
+
+		:Example:
+		>>> deletions = db.deletions
+		>>> db.delete([2, 3])
+		>>> print(db.deleted_since(deletions))
+		<<< [2 3]
+		"""
+		if deletions >= self.deletions:
+			return np.zeros(0, dtype=np.int64)
+		if deletions < self.deleted_first:
+			return None
+		return np.concatenate(list(itertools.islice(self.deleted_keys, deletions - self.deleted_first, None)))
+
+	def compact(self):
+		"""
+		Reclaims the space of deleted records by removing their rows from
+		the columns. Keys are never reused, so the remaining keys (and
+		structures referring to them) stay valid.
+
+		:Example:
+		>>> db.compact()
 		"""
-		return [ self.insert(record) for record in records]
+		if self.num_deleted == 0:
+			return
+
+		alive = ~self.tombstones[:self.size]
+		for field, column in self.columns_.items():
+			self.columns_[field] = column[:self.size][alive]
+
+		self.size = len(self.columns_["key"])
+		self.tombstones = None
+		self.num_deleted = 0
+		self.changed()
+
+	def column(self, field, keys = None):
+		"""
+		Returns the values of a field. Without keys this is a view on the
+		column (without copying, unless there are deleted rows that were not
+		compacted yet), with keys the values are returned in order of the
+		requested keys.
+
+		:param field: the field name
+		:param keys : optional collection of keys
+
+		:Example:
+		>>> db.column("x")
+		<<< [9. 1. 2. 3.]
+
+		>>> db.column("x", [2, 4])
+		<<< [1. 3.]
+		"""
+		if keys is None:
+			if self.num_deleted > 0:
+				return self.columns_[field][:self.size][~self.tombstones[:self.size]]
+			return self.columns_[field][:self.size]
+		return self.columns_[field][self.rows(keys)]
+
+	def columns(self):
+		"""
+		Returns a dictionary with a view on every column (including the key),
+		the views share memory with the Database and support the buffer
+		protocol/__array_interface__, so they can be handed to other code
+		without copying.
+
+		:Example:
+		>>> db.columns()
+		<<< {'key': array([1, 2]), 'x': array([9., 1.]), 'y': array([10.,  2.])}
+		"""
+		return {field : self.column(field) for field in self.fields_}
 
 	def query(self, key):
 		"""
-		Returns a list of records in order of the requested keys.
+		Returns a matrix of records in order of the requested keys.
 		The first field of each record corresponds to the unique key.
-		
+
 		:param key: a collection or a single key
 
 		:Example:
 		>>> db.query(2)
-		<<< [2, 1, 2, 3]
+		<<< [2. 1. 2. 3.]
 
 		>>> db.query([2, 4])
-		<<< [[2, 1, 2, 3], [4, 3, 4, 5]]
+		<<< [[2. 1. 2. 3.]
+			 [4. 3. 4. 5.]]
 		"""
-		if isinstance(key,int):
-			if key in self.db:
-				return self.db[key]
-			return None
+		if isinstance(key,(int, np.integer)):
+			rows = self.rows([key])
+			if len(rows) == 0:
+				return None
+			return self.records(rows)[0]
 		try:
-			return [self.db[k] for k in key if k in self.db] 
-		except ValueError:
+			return self.records(self.rows(key))
+		except (ValueError, TypeError):
 			pass
 
 		return None
 
+	def records(self, rows):
+		"""
+		Internal method that gathers the given rows into a
+		(n, fields) matrix.
+		"""
+		data = np.empty((len(rows), len(self.fields_)), dtype=np.float64)
+		for field, index in self.fields_.items():
+			data[:, index] = self.columns_[field][rows]
+		return data
+
 	def keys(self):
 		"""
 		Returns all the unique keys
 
 		:Example:
 		>>> print(db.keys())
-		<<< [1, 2, 3, 4]
+		<<< [1 2 3 4]
 		"""
-		return [x for x in self.db.keys()]
+		return self.column("key")
+
+	def keys_since(self, key):
+		"""
+		Returns the keys of the records inserted after the given key
+
+		:Example:
+		>>> print(db.keys_since(2))
+		<<< [3 4]
+		"""
+		column = self.columns_["key"][:self.size]
+		first = np.searchsorted(column, key, "right")
+		if self.num_deleted > 0:
+			return column[first:][~self.tombstones[first:self.size]]
+		return column[first:]
+
+	def create_index(self, field):
+		"""
+		Creates a sorted secondary index on a field, which is kept up to
+		date by insert/update_field and used by where, see
+		secondaryindex.SecondaryIndex.
+
+		:param field: the field name
+
+		:Example:
+		>>> db.create_index("quad-lvl")
+		"""
+		if field not in self.fields_ or field == "key":
+			raise ValueError('Can not index the field %s.' % field)
+		self.indexes[field] = si.SecondaryIndex(self, field)
+
+	def where(self, field, op, value):
+		"""
+		Returns the keys of the records for which `field op value` holds,
+		op is one of ==, <, <=, >, >=. Uses the field's index when there is
+		one, otherwise the column is scanned.
+
+		:param field: the field name
+		:param op	: the comparison operator
+		:param value: the value to compare with
+
+		:Example:
+		>>> print(db.where("quad-lvl", "<", 4))
+		<<< [1 2 3]
+		"""
+		if field in self.indexes:
+			return self.indexes[field].lookup(op, value)
+
+		if op not in si.SecondaryIndex.OPERATORS:
+			raise ValueError('Unsupported operator %s.' % op)
+		return self.keys()[si.SecondaryIndex.OPERATORS[op](self.column(field), value)]
 
 	def update(self,key,index,value):
 		"""
-		Updates a value for a field given the key 
+		Updates a value for a field given the key
 
-		:param key	: unique key 
+		:param key	: unique key
 		:param index: index in the field to update
 		:param value: the new value
 
 		:Example:
-		>>> db.update(1,0,9)
+		>>> db.update(1,1,9)
 		"""
-		self.db[key][index] = value
-	
+		field = [name for name, idx in self.fields_.items() if idx == index][0]
+		self.update_field(key, field, value)
+
 	def update_field(self,key,field,value):
 		"""
-		Updates a value for a field given the key 
+		Updates a value for a field given the key, key and value may also
+		be collections (of equal length) to update many records at once.
 
-		:param key	: unique key 
+		:param key	: unique key(s)
 		:param field: the field to updated
-		:param value: the new value
+		:param value: the new value(s)
 
 		:Example:
 		>>> db.update_field(1,"x",9)
+		>>> db.update_field([1, 2],"x",[9, 7])
+		"""
+		if isinstance(key,(int, np.integer)):
+			rows = self.rows([key])
+			if len(rows) == 0:
+				raise KeyError(key)
+			self.columns_[field][rows[0]] = value
+		else:
+			self.columns_[field][self.rows(key)] = value
+		self.changed(field)
+
+		if field in self.indexes:
+			self.indexes[field].touch(key)
+
+	def update_column(self, field, values):
+		"""
+		Replaces all the values of a field at once, values is in the
+		order of keys().
+
+		:param field : the field to update
+		:param values: a collection with a value for every record (or a single value)
+
+		:Example:
+		>>> db.update_column("quad-lvl", [1, 2, 0, 0])
 		"""
-		self.update(key,self.fields_[field],value)
+		if self.num_deleted > 0:
+			self.columns_[field][:self.size][~self.tombstones[:self.size]] = values
+		else:
+			self.columns_[field][:self.size] = values
+		self.changed(field)
+
+		if field in self.indexes:
+			self.indexes[field].rebuild = True
+
+	@staticmethod
+	def from_columns(columns, keys = None):
+		"""
+		Creates a Database on top of existing column buffers (numpy arrays or
+		any object supporting the buffer protocol) without copying them. The
+		buffers stay owned by the caller, only when records are appended the
+		Database moves to its own (grown) copy of the columns.
+
+		:param columns: a dictionary mapping field names on 1 dimensional buffers
+		:param keys   : optional increasing unique keys, defaults to 1..n
+
+		:Example:
+		>>> points = np.array([[2., 3.], [5., 4.]])
+		>>> db = Database.from_columns({"x": points[:,0], "y": points[:,1]})
+		>>> print(np.shares_memory(db.column("x"), points))
+		<<< True
+		"""
+		columns = {field : np.asarray(buffer) for field, buffer in columns.items()}
+
+		sizes = set(len(column) for column in columns.values())
+		if len(sizes) > 1 or any(column.ndim != 1 for column in columns.values()):
+			raise ValueError('The columns must be 1 dimensional and of equal length.')
+		size = sizes.pop() if sizes else 0
+
+		if keys is None:
+			keys = np.arange(1, size + 1, dtype=np.int64)
+		keys = np.asarray(keys, dtype=np.int64)
+		if len(keys) != size or np.any(keys[1:] <= keys[:-1]):
+			raise ValueError('The keys must be increasing and match the columns length.')
+
+		database = Database(list(columns.keys()), {field : column.dtype for field, column in columns.items()})
+		database.adopt(columns, keys, int(keys[-1]) if size > 0 else 0)
+		return database
+
+	def adopt(self, columns, keys, unique_key, tombstones = None, num_deleted = 0):
+		"""
+		Internal method that replaces the Database's columns by the given
+		arrays, without copying or validating them.
+		"""
+		self.columns_["key"] = keys
+		self.columns_.update(columns)
+		self.size = len(keys)
+		self.unique_key = unique_key
+
+		self.tombstones = tombstones if num_deleted > 0 else None
+		self.num_deleted = num_deleted
+		self.changed()
+
+	def save(self, path):
+		"""
+		Saves the Database to a binary file, see binaryfile.BinaryFile, with the
+		field schema and row count in the header followed by one contiguous
+		array per column (and the tombstone bitmap when records were deleted).
+
+		:param path: the file name
+
+		:Example:
+		>>> db.save("points.db")
+		"""
+		fields = sorted(self.fields_, key=lambda field: self.fields_[field])
+		meta = {
+			"fields" : fields[1:],
+			"rows" : self.size,
+			"unique_key" : self.unique_key,
+			"deleted" : self.num_deleted
+		}
+		arrays = [(field, self.columns_[field][:self.size]) for field in fields]
+		if self.num_deleted > 0:
+			arrays.append(("tombstones", self.tombstones[:self.size]))
+		bf.BinaryFile.write(path, Database.MAGIC, meta, arrays)
+
+	@staticmethod
+	def open(path, mmap = True):
+		"""
+		Opens a Database saved by save. With mmap the columns are memory-mapped
+		(copy-on-write), so opening takes constant time, pages are only loaded
+		when touched and processes opening the same file share them. Changes
+		are not written back, use save for that.
+
+		:param path: the file name
+		:param mmap: memory-map the columns instead of reading them
+
+		:Example:
+		>>> db = Database.open("points.db")
+		"""
+		meta, arrays = bf.BinaryFile.read(path, Database.MAGIC, mmap)
+
+		database = Database(meta["fields"], {field : arrays[field].dtype for field in meta["fields"]})
+		database.adopt({field : arrays[field] for field in meta["fields"]}, arrays["key"], meta["unique_key"],
+					   arrays.get("tombstones"), meta.get("deleted", 0))
+		return database
 
 if __name__ == '__main__':
 
-	# 1 creating a database with the following fields in order:	
+	# 1 creating a database with the following fields in order:
 	db = Database(["x","y","quad-lvl"])
-		
-	print("Creating a database")	
+
+	print("Creating a database")
 	for name,index in db.fields().items():
 		print("name: %s Index: %i" % (name,index))
 
 	# adding contents
-	print("Adding contents")	
+	print("Adding contents")
 	db.insert([1,2])
 	db.insert([1,2,3])
 	db.insert_iterable([[2,3],[3,4,5]])
+	db.insert_iterable(np.array([[1,2],[3,4]]))
 
 	db.update_field(1,"x",9)
 	db.update(1,2,10)
 	for record in db.query(db.keys()):
 		print ("record", record)
 
-	
-
+	print(db.column("x"))
+	print(db.column("x", [2, 4]))
 
+	# sharing columns without copying
+	points = np.array([[2., 3.], [5., 4.]])
+	shared = Database.from_columns({"x": points[:,0], "y": points[:,1]})
+	print(shared.columns())
+	print(np.shares_memory(shared.column("x"), points))
 
+	# persisting
+	db.save("example.db")
+	opened = Database.open("example.db")
+	print(opened.query(opened.keys()))
+	os.remove("example.db")
 
+	# deleting
+	print(db.delete([3, 10]))
+	print(db.keys(), db.contains([2, 3]))
+	db.compact()
+	print(db.query(db.keys()))
 
- 
-	
+	# secondary indexes
+	db.create_index("quad-lvl")
+	db.update_field(2, "quad-lvl", 1)
+	print(db.where("quad-lvl", "<", 3), db.where("quad-lvl", "==", 5))
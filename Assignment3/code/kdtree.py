@@ -1,9 +1,18 @@
 import numpy as np
+import heapq
 import math
+import os
+import zlib
+import functools
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 import boundingbox as bb
 import database as db
-import storageindex as si
 import balancedtreefunctions as btf
+import binaryfile as bf
+import querystats as qs
+import querycache as qc
 
 class KDTree:
 	"""
@@ -22,99 +31,590 @@ class KDTree:
 		1. max-depth    : the maximum tree depth
 		2. max-elements : maximum amount of elements in leave nodes
 		incase depth is not sufficient for max-elements, the depth is recalculated
+		3. compact-ratio: the ratio of deleted elements after which the tree
+		is compacted (default 0.25), see compact
+		4. fields       : the Database fields that are indexed (default ["x", "y"]),
+		any number >= 2 of fields, e.g. ["x", "y", "z", "time"]
+		5. split-rule   : how a node chooses its axis and split value
+			alternate        : axis = depth % dimension, split on the median (default)
+			max-spread       : the axis on which the node's elements spread the most,
+							   split on the median
+			sliding-midpoint : the longest side of the node's cell, split in the
+							   middle, slid to the closest element when one side
+							   would be empty. The tree is not balanced, so
+							   leaves on max-depth can hold more than max-elements
+		max-spread and sliding-midpoint avoid long thin cells on elongated data.
+		6. build-workers: the amount of processes used for building the tree
+		(default 1), see build_parallel
+		7. cache-bytes  : the memory for caching the results of rquery and
+		closest (default 0, no cache), see cached_rquery. The cache is
+		cleared by every write to the indexed fields of the Database and
+		by insert/compact
+		8. cache-resolution: the grid cells per side of the root cell to
+		which the boxes of cached range queries are rounded (default 1024)
 
-	the tree is internally stored in an array containing the following information:
-	>>> for node in tree.storage:
-	>>>		print(node)
-	<<< {'index': 1, 'depth': 0, 'partition': 5, 'axis': 0}
-	<<<	{'index': 2, 'depth': 1, 'partition': 4, 'axis': 1}
-	<<< {'index': 3, 'depth': 1, 'partition': 2, 'axis': 1}
-	<<< {'index': 4, 'depth': 2, 'elements': array([1, 2]), 'axis': 0}
-	<<<	{'index': 5, 'depth': 2, 'elements': array([4]), 'axis': 0}
-	<<<	{'index': 6, 'depth': 2, 'elements': array([5, 6]), 'axis': 0}
-	<<<	{'index': 7, 'depth': 2, 'elements': array([3]), 'axis': 0}	
+	the tree is internally stored in a set of flat arrays, one entry per node
+	where the node's position is its binary tree index (breadth first) - 1:
+	>>> print(tree.axis)
+	<<< [0 1 1 0 0 0 0]
+	>>> print(tree.split)
+	<<< [ 5.  4.  2. nan nan nan nan]
+	>>> print(tree.start, tree.end)
+	<<< [0 0 3 0 2 3 5] [6 3 6 2 3 5 6]
+	>>> print(tree.keys)
+	<<< [1 2 4 5 6 3]
 	
 		where
-			index		: is the node's binary tree index (breadth first)
-			depth 		: is the depth of the node
-			partition	: on what value the space was partitioned
-			elements	: the keys stored in this node (unique key in Database)
-			axis		: the current axis (is depth % dimension)
+			axis		: the node's axis (chosen by the split-rule), -1 for unused nodes
+			split		: on what value the space was partitioned, nan for leaves
+			leaf		: wheter the node is a leaf
+			start, end	: the range of the node's subtree in keys/points
+			keys		: the unique keys (in Database) ordered by the tree, the
+						  elements of a node are keys[start:end]
+			points		: the (n, dimension) coordinates of keys
+			lower, upper: the corners of the root cell, the bounding box of points
+
+	the queries take points and boxes in the order of the fields, a
+	BoundingBox covers the first two fields. The work done by every query
+	can be recorded with trace.
 	"""
+	MAGIC = b"INFOKDT\0"
+	ARRAYS = ["axis", "split", "leaf", "start", "end", "keys", "points"]
+	NODE_ARRAYS = ["axis", "split", "leaf", "start", "end"]
+	SPLIT_RULES = ["alternate", "max-spread", "sliding-midpoint"]
+	# the amount of queries closest_many walks through a tree at once
+	CLOSEST_CHUNK = 4096
+
 	def __init__(self, db, options):
 		"""
 		Create a new KDTree instance.
-		:param db		: Database with fields x,y
+		:param db		: Database with the indexed fields (default x,y)
 		:param options	: options for configuring the KDTree
 
 		:Example:
 		>>>	tree = KDTree(database,{"max-depth":3})
+		>>>	tree = KDTree(database,{"fields":["x","y","z"], "split-rule":"max-spread"})
+		"""
+		self.init_state(db, options)
+		self.build(db.keys(), self.coordinates(db.keys()))
+
+	@staticmethod
+	def from_points(keys, coordinates, options):
+		"""
+		Creates a KDTree directly from keys and their (n, dimension)
+		coordinates, without a Database.
+
+		:Example:
+		>>> tree = KDTree.from_points([1, 2], [[2., 3.], [5., 4.]], {"max-elements": 1})
+		"""
+		tree = KDTree.__new__(KDTree)
+		tree.init_state(None, options)
+		tree.build(np.asarray(keys, dtype=np.int64), np.asarray(coordinates, dtype=np.float64).reshape(len(keys), -1))
+		return tree
+
+	def init_state(self, db, options):
+		"""
+		Internal method that sets the state shared by every way a KDTree is
+		created (the constructor, from_points, load and the build workers),
+		besides the arrays set by build or load.
+		"""
+		self.db = db
+		self.options = options
+		self.forest = []
+		self.alive = None
+		self.num_deleted = 0
+		self.key_order = None
+		self.deletions = db.deletions if db is not None else 0
+		self.stats = None
+		self.changes = 0
+		self.cache = KDTree.make_cache(options)
+		self.partition = lambda x, kth: x.argpartition(kth)
+
+	@staticmethod
+	def make_cache(options):
+		"""
+		Internal method that returns the QueryCache for the cache-bytes
+		option, or None.
+		"""
+		if options.get("cache-bytes", 0) > 0:
+			return qc.QueryCache(options["cache-bytes"])
+		return None
+
+	def version(self):
+		"""
+		Internal method that returns the version of the data the queries
+		run on, which changes with every write to the indexed fields of the
+		Database and every insert or compact of the tree.
+		"""
+		return (self.db.version(self.fields()) if self.db is not None else 0, self.changes)
+
+	def fields(self):
+		"""
+		Returns the indexed Database fields
+		"""
+		return list(self.options.get("fields", ["x", "y"]))
+
+	def coordinates(self, keys):
+		"""
+		Internal method that returns the (n, dimension) coordinates of the
+		Database records with the given keys.
+		"""
+		return np.column_stack([self.db.column(field, keys) for field in self.fields()]).astype(np.float64, copy=False)
+
+	def build(self, keys, coordinates):
+		"""
+		Internal method that (re)builds the tree from the keys and their
+		(n, dimension) coordinates, according to the options.
 		"""
-		keys = db.keys()
-		data = np.asarray(db.query(keys))
 		treef= btf.BalancedTreeFunctions
 
-		if "max-depth" in options:
-			self.max_depth = options["max-depth"]
+		self.dimension = coordinates.shape[1]
+		if self.dimension < 2:
+			raise ValueError('A KDTree needs at least two fields.')
+		self.split_rule = self.options.get("split-rule", "alternate")
+		if self.split_rule not in KDTree.SPLIT_RULES:
+			raise ValueError('Unknown split-rule %s.' % self.split_rule)
+
+		if "max-depth" in self.options:
+			self.max_depth = self.options["max-depth"]
 		else:
-			self.max_depth = treef.tree_depth(len(data))
+			self.max_depth = max(treef.tree_depth(len(keys)), 1)
 		
-		if "max-elements" in options:
-			max_elem_depth = treef.tree_depth_max_leave_elements(len(data),options["max-elements"])
+		if "max-elements" in self.options:
+			max_elem_depth = treef.tree_depth_max_leave_elements(len(keys),self.options["max-elements"])
 			if self.max_depth < max_elem_depth:
 				self.max_depth = max_elem_depth
-			
-		self.partition = lambda x, index: np.argsort(x[:,index],axis=0)
 
 		storage_size = int(math.pow(2,self.max_depth)-1)
 
-		self.storage = storage = [{} for x in range(storage_size)]	
+		self.axis = np.full(storage_size, -1, dtype=np.int8)
+		self.split = np.full(storage_size, np.nan)
+		self.leaf = np.zeros(storage_size, dtype=bool)
+		self.start = np.zeros(storage_size, dtype=np.int64)
+		self.end = np.zeros(storage_size, dtype=np.int64)
 
-		self.traverse(data)
+		self.lower = np.min(coordinates, axis=0)
+		self.upper = np.max(coordinates, axis=0)
+
+		order = np.arange(len(keys))
+		workers = self.options.get("build-workers", 1)
+		if workers > 1 and len(keys) >= 2 ** 16:
+			order = self.build_parallel(coordinates, order, workers)
+		else:
+			self.traverse(coordinates, order, 0, len(order))
+
+		self.keys = keys[order]
+		self.points = coordinates[order]
+		self.alive = None
+		self.num_deleted = 0
+		self.key_order = None
+
+	def build_parallel(self, coordinates, order, workers):
+		"""
+		Internal method that builds the tree on a pool of worker processes,
+		returns the reordered order.
+
+		The coordinates, order and node arrays are copied into shared memory.
+		Subtrees are independent (disjoint node indices and disjoint ranges
+		of order), so the workers build them in place. The top
+		ceil(log2(workers)) levels are split one level at a time, the nodes
+		of a level in parallel, until there is about one subtree per worker
+		(median splits give subtrees of equal size, sliding-midpoint splits
+		2 more levels to even out its uneven subtrees). The subtrees are
+		then built completely, the largest first. Afterwards the arrays are
+		copied out of shared memory.
+
+		Level l of the top levels runs on 2**l workers, so the top levels
+		together cost about 2 passes over the elements, and the copies
+		about 2 more. The speedup is therefore bounded by about
+		max_depth / 4, e.g. 6x for a tree of 24 levels.
+		"""
+		arrays = {"coordinates" : coordinates, "order" : order, "axis" : self.axis, "split" : self.split,
+				  "leaf" : self.leaf, "start" : self.start, "end" : self.end}
+		blocks = {name : shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1)) for name, array in arrays.items()}
+		try:
+			shared = {}
+			for name, array in arrays.items():
+				shared[name] = np.ndarray(array.shape, array.dtype, buffer=blocks[name].buf)
+				shared[name][...] = array
+			layout = {name : (blocks[name].name, array.shape, array.dtype.str) for name, array in arrays.items()}
+
+			for name in KDTree.NODE_ARRAYS:
+				setattr(self, name, shared[name])
+			levels = int(math.ceil(math.log2(workers))) + (2 if self.split_rule == "sliding-midpoint" else 0)
+			levels = min(levels, self.max_depth - 1)
+			settings = (self.max_depth, self.dimension, self.split_rule)
+			tasks = [(0, len(order), 0, 0, self.lower, self.upper)]
+			with ProcessPoolExecutor(workers) as pool:
+				for level in range(levels):
+					split = functools.partial(KDTree.build_subtree, layout, settings, 1)
+					tasks = [task for deferred in pool.map(split, tasks) for task in deferred]
+
+				tasks.sort(key=lambda task: task[0] - task[1])
+				build = functools.partial(KDTree.build_subtree, layout, settings, None)
+				list(pool.map(build, tasks))
+
+			for name in KDTree.NODE_ARRAYS:
+				setattr(self, name, shared[name].copy())
+			order = shared["order"].copy()
+			del shared
+		finally:
+			for block in blocks.values():
+				block.close()
+				block.unlink()
+		return order
+
+	@staticmethod
+	def build_subtree(layout, settings, levels, task):
+		"""
+		Internal method run by the worker processes of build_parallel, builds
+		the subtree of task = (start, end, node, depth, lower, upper) in the
+		shared memory blocks described by layout. With levels only that many
+		levels are built, the tasks of the nodes below them are returned.
+		"""
+		blocks = {name : shared_memory.SharedMemory(name=block) for name, (block, shape, dtype) in layout.items()}
+		try:
+			arrays = {name : np.ndarray(shape, dtype, buffer=blocks[name].buf) for name, (block, shape, dtype) in layout.items()}
+			tree = KDTree.__new__(KDTree)
+			tree.init_state(None, {})
+			tree.max_depth, tree.dimension, tree.split_rule = settings
+			for name in KDTree.NODE_ARRAYS:
+				setattr(tree, name, arrays[name])
+
+			tasks = []
+			defer = (task[3] + levels, tasks) if levels is not None else None
+			tree.traverse(arrays["coordinates"], arrays["order"], *task, defer=defer)
+			del arrays, tree
+		finally:
+			for block in blocks.values():
+				block.close()
+		return tasks
+
+	@property
+	def bb(self):
+		"""
+		The root cell as a BoundingBox (on the first two fields)
+		"""
+		return bb.BoundingBox(self.lower[0], self.upper[0], self.lower[1], self.upper[1])
+
+	def trees(self):
+		"""
+		Returns a list with this tree followed by the trees of its forest,
+		which hold the elements added by insert.
+		"""
+		return [self] + [tree for tree in self.forest if tree is not None]
+
+	def insert(self, keys):
+		"""
+		Adds Database records, which are not in the tree yet, to the tree
+		without rebuilding it.
+
+		The new elements are kept in a forest of smaller KDTrees (the
+		logarithmic method): forest[i] is empty or holds at most
+		max-elements * 2**i elements. Inserting merges the new elements with
+		the first forest trees until they fit in a slot, so every element is
+		rebuilt O(log n) times. Once the forest holds more elements than the
+		tree itself, everything is rebuilt into a single tree. Leaves stay
+		bounded by max-elements (or the tree's largest leaf).
+
+		:param keys: the unique keys of the records to add
+
+		:Example:
+		>>> tree.insert(database.insert_iterable([[3,5], [6,6]]))
+		"""
+		if self.db is None:
+			raise ValueError('This KDTree has no Database to insert from.')
+
+		keys = self.db.column("key", keys)
+		if len(keys) == 0:
+			return
+		points = self.coordinates(keys)
+		self.changes += 1
+		self.refresh()
+
+		max_elements = self.options.get("max-elements", max(int(np.max(self.end[self.leaf] - self.start[self.leaf])), 1))
+		slot = 0
+		while True:
+			if slot == len(self.forest):
+				self.forest.append(None)
+
+			if self.forest[slot] is not None:
+				tree_keys, tree_points = self.forest[slot].elements()
+				keys = np.concatenate((keys, tree_keys))
+				points = np.concatenate((points, tree_points))
+				self.forest[slot] = None
+
+			if len(keys) <= max_elements * 2 ** slot:
+				options = {"max-elements" : max_elements, "fields" : self.fields(), "split-rule" : self.split_rule}
+				self.forest[slot] = KDTree.from_points(keys, points, options)
+				break
+			slot += 1
+
+		trees = self.trees()
+		if sum(len(tree.keys) for tree in trees[1:]) > len(self.keys):
+			elements = [tree.elements() for tree in trees]
+			self.forest = []
+			self.build(np.concatenate([keys for keys, points in elements]), np.concatenate([points for keys, points in elements]))
+
+	def elements(self):
+		"""
+		Returns the keys and coordinates of the (not deleted)
+		elements in this tree, in tree order.
+		"""
+		if self.alive is None:
+			return self.keys, self.points
+		return self.keys[self.alive], self.points[self.alive]
+
+	def refresh(self):
+		"""
+		Internal method called before every query, which brings the masks
+		of deleted elements (alive, None when nothing is deleted) up to date
+		with the deletes in the Database. Only the keys deleted since the
+		last call are marked, see Database.deleted_since, when the log of
+		the Database does not reach back far enough all keys are checked.
+		Once the ratio of deleted elements passes the compact-ratio option
+		the trees are compacted.
+		"""
+		if self.db is None or self.db.deletions == self.deletions:
+			return
+		keys = self.db.deleted_since(self.deletions)
+		self.deletions = self.db.deletions
+
+		for tree in self.trees():
+			if keys is not None:
+				tree.mark_deleted(keys)
+			else:
+				alive = self.db.contains(tree.keys)
+				tree.alive = None if np.all(alive) else alive
+				tree.num_deleted = len(alive) - np.count_nonzero(alive)
+
+		threshold = self.options.get("compact-ratio", 0.25)
+		if sum(tree.num_deleted for tree in self.trees()) > threshold * sum(len(tree.keys) for tree in self.trees()):
+			self.compact(threshold)
+
+	def mark_deleted(self, keys):
+		"""
+		Internal method that clears the alive entries of the elements with
+		the given keys, keys that are not in this tree are ignored. The keys
+		are looked up with binary search on key_order, the positions of the
+		elements sorted by key, which is computed on the first delete after
+		a (re)build.
+		"""
+		if len(keys) == 0 or len(self.keys) == 0:
+			return
+		if self.key_order is None:
+			self.key_order = np.argsort(self.keys)
+
+		index = np.minimum(np.searchsorted(self.keys, keys, sorter=self.key_order), len(self.keys) - 1)
+		positions = self.key_order[index]
+		positions = positions[self.keys[positions] == keys]
+		if len(positions) == 0:
+			return
+
+		if self.alive is None:
+			self.alive = np.ones(len(self.keys), dtype=bool)
+		positions = positions[self.alive[positions]]
+		self.alive[positions] = False
+		self.num_deleted += len(positions)
+
+	def compact(self, threshold = None):
+		"""
+		Removes the elements that were deleted from the Database from the
+		trees. Subtrees in which more than threshold (default the
+		compact-ratio option) of the elements were deleted are rebuilt,
+		the other nodes only have their ranges moved.
+
+		:param threshold: the ratio of deleted elements for rebuilding a subtree
+
+		:Example:
+		>>> database.delete([1, 2])
+		>>> tree.compact()
+		"""
+		if threshold is None:
+			threshold = self.options.get("compact-ratio", 0.25)
+
+		self.refresh()
+		self.changes += 1
+		for tree in self.trees():
+			tree.compact_tree(threshold)
+		self.forest = [tree if tree is not None and len(tree.keys) > 0 else None for tree in self.forest]
+
+	def compact_tree(self, threshold):
+		"""
+		Internal method that compacts a single tree, see compact.
+		"""
+		if self.alive is None:
+			return
+
+		# shift the ranges by the amount of deleted elements in front of them
+		deleted = np.concatenate(([0], np.cumsum(~self.alive)))
+		removed = deleted[self.end] - deleted[self.start]
+		size = self.end - self.start
+		self.start = self.start - deleted[self.start]
+		self.end = self.end - deleted[self.end]
+		self.keys = self.keys[self.alive]
+		self.points = self.points[self.alive]
+		self.alive = None
+		self.num_deleted = 0
+		self.key_order = None
+
+		# rebuild the highest subtrees with too many deleted elements, leaves
+		# stay leaves. The subtrees are disjoint, so they share one order array
+		order = None
+		nodes = [0]
+		while nodes:
+			node = nodes.pop()
+			if self.leaf[node]:
+				continue
+			if removed[node] > threshold * size[node]:
+				if order is None:
+					order = np.arange(len(self.keys))
+				self.rebuild(node, order)
+			else:
+				nodes.extend((2 * node + 1, 2 * node + 2))
+
+	def rebuild(self, node, order):
+		"""
+		Internal method that rebuilds the subtree of node from the
+		elements in its range, order is an array with order[i] = i for
+		the positions in that range, which is permuted by the rebuild.
+		"""
+		depth = (node + 1).bit_length() - 1
+		start, end = self.start[node], self.end[node]
+
+		for level in range(self.max_depth - depth):
+			first = (node + 1) * 2 ** level - 1
+			nodes = slice(first, first + 2 ** level)
+			self.axis[nodes] = -1
+			self.split[nodes] = np.nan
+			self.leaf[nodes] = False
+			self.start[nodes] = 0
+			self.end[nodes] = 0
+
+		lower, upper = self.cell(node)
+		self.traverse(self.points, order, start, end, node, depth, lower, upper)
+		segment = order[start:end]
+		self.keys[start:end] = self.keys[segment]
+		self.points[start:end] = self.points[segment]
+
+	def cell(self, node):
+		"""
+		Returns the (lower, upper) corners of the cell of a node, following
+		the splits from the root.
+		"""
+		path = []
+		while node > 0:
+			path.append(node)
+			node = (node - 1) // 2
+
+		lower, upper = self.lower.copy(), self.upper.copy()
+		for node in reversed(path):
+			parent = (node - 1) // 2
+			if node % 2 == 1:
+				upper[self.axis[parent]] = self.split[parent]
+			else:
+				lower[self.axis[parent]] = self.split[parent]
+		return lower, upper
 
-		self.bb = bb.BoundingBox.from_dataset(data,db.fields()["x"],db.fields()["y"])				  
-	
 	def bounding_box(self):
 		"""
 		Returns the Minimum BoundingBox (MBR) of the KDTree
+		(including the elements added by insert)
 		
 		:Example:
 		>>> print(tree.bounding_box())
 		<<< [[ 2.  9.]
  			 [ 1.  7.]]
 		"""
-		return self.bb
+		if len(self.trees()) == 1:
+			return self.bb
 
-	def traverse(self,mtrx, depth = 0, sidx = si.StorageIndex()): 
+		return bb.BoundingBoxArray.from_boxes([tree.bb for tree in self.trees()]).union()
+
+	def traverse(self, coordinates, order, start, end, node = 0, depth = 0, lower = None, upper = None, defer = None): 
 		"""
-		Internal used method for creating the QuadTree.
+		Internal used method for creating the KDTree.
 
 		This method will be called recursively until the maximum depth
-		is reached. In every step it will split the data along a certain
-		axis into two equal sized (median) partitions.
+		is reached. In every step it will split the data along the axis
+		chosen by the split-rule into two partitions, see choose_split.
+
+		The coordinates are never copied, order[start:end] holds the row
+		indices of the current node and is reordered in place by a linear
+		time selection, the children continue on both halves. lower and
+		upper are the corners of the node's cell.
 
-		Technically the partion function only needs to be called once,
-		but is done repeatedly for clarity.
+		With defer = (depth, tasks) the nodes on that depth are not built,
+		their arguments are appended to tasks instead, see build_parallel.
 		"""
-		axis = depth % 2		
-        
-		self.storage[sidx.storage()]["index"] = sidx.tree()
-		self.storage[sidx.storage()]["depth"] = depth
-		self.storage[sidx.storage()]["axis"] = axis		
+		if lower is None:
+			lower, upper = self.lower, self.upper
+
+		if defer is not None and depth == defer[0]:
+			defer[1].append((start, end, node, depth, lower, upper))
+			return
+
+		self.axis[node] = depth % self.dimension
+		self.start[node] = start
+		self.end[node] = end
     	
-		# if no more splitting, store ids from the matrix
-		if len(mtrx) == 1 or depth + 1 == self.max_depth:
-			self.storage[sidx.storage()]["elements"] = mtrx[:,0]
+		# if no more splitting, the node's elements are order[start:end]
+		if end - start <= 1 or depth + 1 == self.max_depth:
+			self.leaf[node] = True
+		else:
+			segment = order[start:end]
+			axis, median, split = self.choose_split(coordinates, segment, depth, lower, upper)
+			self.axis[node] = axis
+			self.split[node] = split
+
+			# only sliding-midpoint uses the cells
+			left_upper, right_lower = upper, lower
+			if self.split_rule == "sliding-midpoint":
+				left_upper, right_lower = upper.copy(), lower.copy()
+				left_upper[axis] = split
+				right_lower[axis] = split
+			self.traverse(coordinates, order, start, start + median, 2 * node + 1, depth + 1, lower, left_upper, defer)
+			self.traverse(coordinates, order, start + median, end, 2 * node + 2, depth + 1, right_lower, upper, defer)
+
+	def choose_split(self, coordinates, segment, depth, lower, upper):
+		"""
+		Internal method that chooses the axis and split value of a node
+		according to the split-rule, and reorders segment in place such that
+		the first median elements are <= split and the others >= split.
+		Returns (axis, median, split).
+		"""
+		if self.split_rule == "alternate":
+			axis = depth % self.dimension
+		elif self.split_rule == "max-spread":
+			values = coordinates[segment]
+			axis = int(np.argmax(values.max(axis=0) - values.min(axis=0)))
 		else:
-			# order the matrix, and partition
-			order = np.array_split(self.partition(mtrx,axis + 1),2)			
-			self.storage[sidx.storage()]["partition"] = mtrx[order[0][-1],axis + 1]
-			self.traverse(mtrx[order[0],:], depth + 1, sidx.left())
-			self.traverse(mtrx[order[1],:], depth + 1, sidx.right())
+			axis = int(np.argmax(upper - lower))
+		values = coordinates[segment, axis]
+
+		if self.split_rule == "sliding-midpoint":
+			split = (lower[axis] + upper[axis]) / 2.0
+			median = int(np.count_nonzero(values <= split))
+			# slide the split to the closest element to keep both sides non empty
+			if median == 0:
+				median, split = 1, values.min()
+			elif median == len(values):
+				median, split = len(values) - 1, values.max()
+			segment[:] = segment[self.partition(values, median - 1)]
+		else:
+			# select the median, everything before it is smaller or equal
+			median = (len(values) + 1) // 2
+			segment[:] = segment[self.partition(values, median - 1)]
+			split = coordinates[segment[median - 1], axis]
+
+		return axis, median, split
 	
-	def partitions(self):
+	def partitions(self, depth = None):
 		"""
-		Returns a dictionary containing lists of BoundingBoxes.
+		Returns the cells of the nodes at the given depth as a
+		BoundingBoxArray, only the levels up to depth are visited. Without
+		a depth a dictionary containing a BoundingBoxArray per depth is
+		returned.
 		{
 			0 : [ 1 x BoundingBox]
 			1 : [ 2 x BoundingBox]
@@ -122,92 +622,765 @@ class KDTree:
 		}
 
 			where the key represents the depth, and the collection of BoundingBoxes
-			make up the entire space containing this KDTree
+			make up the entire space containing this KDTree (leaves that are not
+			on the deepest level are not repeated on the next levels)
+
+		:param depth: the depth of the requested cells
 		
 		:Example:
+		>>> print(len(tree.partitions(2)))
+		<<< 4
 		>>> for k,v in tree.partitions().items():
 		>>>		print(k,len(v))
 		<<< (0, 1)
 		<<< (1, 2)
 		<<< (2, 4)
 		"""
-		bounding_boxes = {}
-		sidx = si.StorageIndex()
-		self.traverse_partition(0,sidx,bounding_boxes,self.bb)
-		return bounding_boxes
-	
-	def traverse_partition(self,depth, sidx, bboxes, box):
+		if depth is None:
+			return dict(self.iter_partitions())
+
+		for level, boxes in self.iter_partitions(depth):
+			if level == depth:
+				return boxes
+		return bb.BoundingBoxArray(np.empty((0, 4)))
+
+	def iter_partitions(self, depth = None):
 		"""
-		Internal method used for collecting the bounding boxes per depth
+		Lazily yields (depth, BoundingBoxArray) pairs, one per level of the
+		tree, starting at the root. Every level is computed from the
+		previous one in a single vectorized step, the iteration stops after
+		depth (when given) or at the deepest level. For trees on more than
+		two fields the cells are projected on the first two fields.
+
+		:param depth: the last depth that is yielded
 
-		This method will be called recursively until all the BoundingBoxes
-		have been collected.
+		:Example:
+		>>> for level, boxes in tree.iter_partitions(1):
+		>>>		print(level, len(boxes))
+		<<< (0, 1)
+		<<< (1, 2)
 		"""
-		if depth not in bboxes:
-			bboxes[depth] = []
-			
-		bboxes[depth].append(box)
+		nodes = np.zeros(1, dtype=np.int64)
+		lower, upper = self.lower[np.newaxis], self.upper[np.newaxis]
+		level = 0
+
+		while len(nodes) > 0 and (depth is None or level <= depth):
+			yield level, bb.BoundingBoxArray(np.column_stack((lower[:, 0], upper[:, 0], lower[:, 1], upper[:, 1])))
 
-		if "index" in self.storage[sidx.storage()]:			
-			axis = depth % 2
+			inner = ~self.leaf[nodes]
+			nodes, lower, upper = self.split_cells(nodes[inner], lower[inner], upper[inner])
+			level += 1
 
-			# there was further partitioning
-			if "partition" in self.storage[sidx.storage()]:
-				
-				left_box = box.reduce_max(axis,self.storage[sidx.storage()]["partition"])
-				right_box = box.reduce_min(axis,self.storage[sidx.storage()]["partition"])
-			
-				self.traverse_partition(depth + 1, sidx.left(), bboxes, left_box)
-				self.traverse_partition(depth + 1, sidx.right(), bboxes, right_box)
+	def split_cells(self, nodes, lower, upper):
+		"""
+		Internal method that returns the children of the (internal) nodes
+		and their cells, all left children followed by all right children.
+		"""
+		rows = np.arange(len(nodes))
+		axis, split = self.axis[nodes], self.split[nodes]
+		left_upper, right_lower = upper.copy(), lower.copy()
+		left_upper[rows, axis] = split
+		right_lower[rows, axis] = split
 
-			else:		
-				return
+		nodes = np.concatenate((2 * nodes + 1, 2 * nodes + 2))
+		return nodes, np.concatenate((lower, right_lower)), np.concatenate((left_upper, upper))
 	
-	def rquery(self,bbox = [], sidx = si.StorageIndex()):
+	@contextlib.contextmanager
+	def trace(self, callback = None, stats = None):
+		"""
+		Context manager that records the counters and the wall time of every
+		query in a querystats.QueryStats, see there for the counters. Outside
+		of trace (stats is None) nothing is counted.
+
+		:param callback	: optional function called with the record of every query
+		:param stats	: an existing QueryStats to add the records to
+
+		:Example:
+		>>> with tree.trace() as stats:
+		>>>		tree.rquery(bbox)
+		>>>		tree.closest([7,2])
+		>>> print(stats.summary()["rquery"]["elements"]["mean"])
+		<<< 3.0
+		>>> stats.dump("queries.json")
 		"""
-		Returns a list of unique keys that fell within the provided BoundingBox.
+		previous = self.stats
+		self.stats = stats if stats is not None else qs.QueryStats(callback)
+		try:
+			yield self.stats
+		finally:
+			self.stats = previous
+
+	def rquery(self, bbox):
+		"""
+		Returns an array of unique keys of the elements that fall within
+		(or on the sides of) the provided BoundingBox.
+
+		The tree is walked level by level on all the cells intersecting the
+		BoundingBox at once. Subtrees whose cell lies completely inside the
+		BoundingBox are returned as a whole, only the leaves on the border
+		of the BoundingBox have their elements tested.
 		
-		:param bbox: the current BoundingBox that will be searched
-		:param sidx: helper class for Binary Tree traversal
+		:param bbox: the BoundingBox that will be searched (on the first two
+					 fields), or a (dimension, 2) array with the [min, max] of
+					 every field
 		
-		>>> bbox = bb.BoundingBox(1,2,1,2)
+		>>> bbox = bb.BoundingBox(1,5,1,4)
 		>>>	print(tree.rquery(bbox))		
-		<<< [1, 2]
+		<<< [1 2]
 		
 		>>> print(database.query(tree.rquery(bbox)))
-		<<< [[1, 2, 3], [2, 5, 4]]		
+		<<< [[1. 2. 3.]
+			 [2. 5. 4.]]
 		"""
-		if "elements" in self.storage[sidx.storage()]:
-			return self.storage[sidx.storage()]["elements"]
-	
+		self.refresh()
+
+		record = self.stats.begin("rquery") if self.stats is not None else None
+		lower, upper = self.query_bounds(bbox)
+		if self.cache is not None:
+			keys = self.cached_rquery(lower[0], upper[0], record)
 		else:
-			axis = self.storage[sidx.storage()]["axis"]
-			partition = self.storage[sidx.storage()]["partition"]
-			lr = bbox.partition(partition,axis)
+			counts, keys = self.rquery_chunk(lower[:1], upper[:1], record)
+		if record is not None:
+			self.stats.end(record, len(keys))
+		return keys
 
-			boxes = []
-			if lr[0]:
-				boxes.extend(self.rquery(bbox,sidx.left()))
-			if lr[1]:
-				boxes.extend(self.rquery(bbox,sidx.right()))
+	def rquery_many(self, boxes, workers = 1, csr = False):
+		"""
+		Runs a batch of range queries, returns a list with the array of keys
+		per box (see rquery), or with csr the (offsets, keys) pair where the
+		keys of box i are keys[offsets[i]:offsets[i + 1]].
 
-		return boxes
-		
-	def closest(self, point, sidx = si.StorageIndex()):
+		All the boxes are pushed through the tree together, level by level
+		on (box, node) pairs. With workers > 1 the boxes are divided in
+		chunks over a pool of threads sharing the (read-only) tree, the
+		work is done by numpy operations on large arrays, which release the GIL.
 
-		if "elements" in self.storage[sidx.storage()]:
-			return self.storage[sidx.storage()]["elements"]
-		else: 
-			axis = self.storage[sidx.storage()]["axis"]
-			partition = self.storage[sidx.storage()]["partition"]
-	
-			leaf_points = []
-			if point[axis] < partition: 
-				leaf_points.extend(self.closest(point, sidx.left()))
-			else: 
-				leaf_points.extend(self.closest(point, sidx.right()))
+		:param boxes	: a BoundingBoxArray, a list of BoundingBoxes or a
+						  (m, dimension, 2) array with the [min, max] per field
+		:param workers	: the amount of threads
+		:param csr		: return (offsets, keys) instead of a list
+
+		:Example:
+		>>> print(tree.rquery_many([bb.BoundingBox(1,5,1,4), bb.BoundingBox(2,6,4,6)]))
+		<<< [array([1, 2]), array([2])]
+		>>> print(tree.rquery_many(boxes, csr = True))
+		<<< (array([0, 2, 3]), array([1, 2, 2]))
+		"""
+		self.refresh()
+
+		lower, upper = self.query_bounds(boxes)
+		chunk = lambda queries, record: self.rquery_chunk(lower[queries], upper[queries], record)
+		return self.run_batched("rquery_many", chunk, len(lower), workers, csr)
+
+	def run_batched(self, name, chunk, count, workers, csr):
+		"""
+		Internal method that runs count queries of a batched query method,
+		divided in chunks over a pool of threads when workers > 1. chunk is
+		called with the indices of the queries of a chunk and the counters
+		for the trace, and returns the amount of keys per query and the keys
+		ordered by query. Returns a list or (offsets, keys), see rquery_many.
+		"""
+		chunks = np.array_split(np.arange(count), max(1, min(count, 4 * workers if workers > 1 else 1)))
+		record = self.stats.begin(name, count) if self.stats is not None else None
+		counters = [qs.QueryStats.counters() if record is not None else None for queries in chunks]
+		if workers > 1:
+			with ThreadPoolExecutor(workers) as pool:
+				results = list(pool.map(chunk, chunks, counters))
+		else:
+			results = [chunk(queries, counter) for queries, counter in zip(chunks, counters)]
+
+		offsets = np.concatenate(([0], np.cumsum(np.concatenate([counts for counts, keys in results])))).astype(np.int64)
+		keys = np.concatenate([keys for counts, keys in results])
+		if record is not None:
+			for counter in counters:
+				qs.QueryStats.add(record, counter)
+			self.stats.end(record, len(keys))
+		if csr:
+			return offsets, keys
+		return [keys[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
 
-		return leaf_points
+	def query_bounds(self, boxes):
+		"""
+		Internal method that returns the (m, dimension) lower and upper
+		corners of one or more query boxes, BoundingBoxes leave the fields
+		after the first two unbounded.
+		"""
+		if isinstance(boxes, bb.BoundingBox):
+			boxes = [boxes]
+		if isinstance(boxes, (list, tuple)) and len(boxes) > 0 and isinstance(boxes[0], bb.BoundingBox):
+			boxes = bb.BoundingBoxArray.from_boxes(boxes)
+
+		if isinstance(boxes, bb.BoundingBoxArray):
+			data = np.tile([-np.inf, np.inf], (len(boxes), self.dimension, 1))
+			data[:, :2] = boxes.matrices()
+		else:
+			data = np.asarray(boxes, dtype=np.float64).reshape(-1, self.dimension, 2)
+		return data[:, :, 0], data[:, :, 1]
+
+	def rquery_chunk(self, lower, upper, record = None):
+		"""
+		Internal method that runs the range queries of the boxes with the
+		given corners on all trees, returns the amount of keys per box and
+		the keys ordered by box. record receives the counters (when traced).
+		"""
+		results = [(tree,) + tree.traverse_rquery(lower, upper, record) for tree in self.trees()]
+		queries = np.concatenate([queries for tree, queries, found in results])
+		keys = np.concatenate([tree.keys[found] for tree, queries, found in results])
+
+		order = np.argsort(queries, kind="stable")
+		return np.bincount(queries, minlength=len(lower)), keys[order]
+
+	def cached_rquery(self, lower, upper, record = None):
+		"""
+		Internal method that runs a single range query through the cache.
+
+		The box is rounded outwards to a grid of cache-resolution cells per
+		side of the root cell, the cache holds the keys and points within the
+		rounded box. The keys within the box are selected from those points,
+		so every box rounding to the same grid cells (e.g. a slightly moved
+		view) is answered without walking the tree.
+		"""
+		self.cache.validate(self.version())
+
+		step = np.where(self.upper > self.lower, self.upper - self.lower, 1.0) / self.options.get("cache-resolution", 1024)
+		limit = 2.0 ** 40
+		low = np.clip(np.floor((lower - self.lower) / step), -limit, limit)
+		high = np.clip(np.ceil((upper - self.lower) / step), -limit, limit)
+		key = ("rquery",) + tuple(low.astype(np.int64).tolist()) + tuple(high.astype(np.int64).tolist())
+
+		entry = self.cache.get(key)
+		if entry is None:
+			# one extra cell on every side absorbs the rounding errors
+			grid_lower = np.where(low > -limit, self.lower + (low - 1) * step, -np.inf)
+			grid_upper = np.where(high < limit, self.lower + (high + 1) * step, np.inf)
+			counters = qs.QueryStats.counters() if record is not None else None
+			results = [(tree, tree.traverse_rquery(grid_lower[None], grid_upper[None], counters)[1]) for tree in self.trees()]
+			entry = (np.concatenate([tree.keys[found] for tree, found in results]),
+					 np.concatenate([tree.points[found] for tree, found in results]))
+			self.cache.put(key, entry)
+			# only the walk counts, the elements of the rounded box are all tested below
+			if record is not None:
+				record["nodes"] += counters["nodes"]
+				record["leaves"] += counters["leaves"]
+		elif record is not None:
+			record["cached"] = 1
+
+		keys, points = entry
+		if record is not None:
+			record["elements"] += len(keys)
+		return keys[((lower <= points) & (points <= upper)).all(axis=1)]
+
+	def ranges(self, nodes):
+		"""
+		Internal method that returns the positions (in keys/points) of the
+		elements of the given nodes, the concatenated start:end ranges.
+		"""
+		sizes = self.end[nodes] - self.start[nodes]
+		offsets = np.repeat(self.start[nodes] - np.cumsum(sizes) + sizes, sizes)
+		return offsets + np.arange(len(offsets))
+
+	def traverse_rquery(self, lower, upper, record = None):
+		"""
+		Internal method used for the range queries, returns the (box, position)
+		pairs of the matches in this tree as two arrays, the positions
+		index keys/points.
+		"""
+		def classify(queries, cell_lower, cell_upper):
+			query_lower, query_upper = lower[queries], upper[queries]
+			intersects = ((query_lower <= cell_upper) & (cell_lower <= query_upper)).all(axis=1)
+			inside = ((query_lower <= cell_lower) & (cell_upper <= query_upper)).all(axis=1)
+			return intersects, inside
+
+		def within(queries, points):
+			return ((lower[queries] <= points) & (points <= upper[queries])).all(axis=1)
+
+		return self.traverse_cells(len(lower), classify, within, record)
+
+	def traverse_cells(self, count, classify, within, record = None):
+		"""
+		Internal method that walks the tree level by level on (query, node)
+		pairs for count queries, returns the (query, position) pairs of the
+		matches in this tree as two arrays.
+
+		classify(queries, cell_lower, cell_upper) returns per pair whether
+		the query region intersects the node's cell and whether it contains
+		the cell: contained subtrees are returned as a whole, intersected
+		inner nodes are split, and the elements of intersected leaves are
+		tested with within(queries, points).
+		"""
+		queries = np.arange(count)
+		nodes = np.zeros(count, dtype=np.int64)
+		cell_lower, cell_upper = np.tile(self.lower, (count, 1)), np.tile(self.upper, (count, 1))
+		found_queries, found = [], []
+
+		while len(nodes) > 0:
+			intersects, inside = classify(queries, cell_lower, cell_upper)
+			leaf = self.leaf[nodes]
+			if record is not None:
+				record["nodes"] += len(nodes)
+
+			whole = nodes[inside]
+			if len(whole) > 0:
+				found.append(self.ranges(whole))
+				found_queries.append(np.repeat(queries[inside], self.end[whole] - self.start[whole]))
+				if record is not None:
+					record["contained"] += len(found[-1])
+			border = intersects & ~inside & leaf
+			if np.any(border):
+				positions = self.ranges(nodes[border])
+				if record is not None:
+					record["leaves"] += int(np.count_nonzero(border))
+					record["elements"] += len(positions)
+				owners = np.repeat(queries[border], self.end[nodes[border]] - self.start[nodes[border]])
+				matches = within(owners, self.points[positions])
+				found.append(positions[matches])
+				found_queries.append(owners[matches])
+
+			inner = intersects & ~inside & ~leaf
+			queries = np.tile(queries[inner], 2)
+			nodes, cell_lower, cell_upper = self.split_cells(nodes[inner], cell_lower[inner], cell_upper[inner])
+
+		if len(found) == 0:
+			return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+		found, found_queries = np.concatenate(found), np.concatenate(found_queries)
+		if self.alive is not None:
+			alive = self.alive[found]
+			found, found_queries = found[alive], found_queries[alive]
+		return found_queries, found
+
+	def radius_query(self, point, r, sort = False):
+		"""
+		Returns an array of unique keys of the elements within (euclidean)
+		distance r of the given point, including the elements at distance r.
+
+		The tree is walked level by level like rquery: cells further than r
+		from the point are skipped, subtrees whose cell lies completely
+		within distance r are returned as a whole, only the leaves on the
+		border of the circle have their distances computed.
+
+		:param point: the query point, one coordinate per field
+		:param r	: the radius
+		:param sort	: order the keys by increasing distance
+
+		:Example:
+		>>> print(tree.radius_query([7,2], 2))
+		<<< [5 6]
+		>>> print(tree.radius_query([7,2], 2, sort = True))
+		<<< [6 5]
+		"""
+		self.refresh()
+
+		record = self.stats.begin("radius_query") if self.stats is not None else None
+		point = np.asarray(point, dtype=np.float64).reshape(1, self.dimension)
+		counts, keys = self.radius_chunk(point, np.array([r], dtype=np.float64), sort, record)
+		if record is not None:
+			self.stats.end(record, len(keys))
+		return keys
+
+	def radius_query_many(self, points, r, sort = False, workers = 1, csr = False):
+		"""
+		Runs a batch of radius queries, returns a list with the array of keys
+		per point (see radius_query), or with csr the (offsets, keys) pair
+		where the keys of point i are keys[offsets[i]:offsets[i + 1]].
+		The queries are pushed through the tree together and divided over
+		threads like rquery_many.
+
+		:param points	: (m, dimension) matrix of query points
+		:param r		: the radius, or an array with a radius per point
+		:param sort		: order the keys of every point by increasing distance
+		:param workers	: the amount of threads
+		:param csr		: return (offsets, keys) instead of a list
+
+		:Example:
+		>>> print(tree.radius_query_many([[7,2], [3,3]], 2))
+		<<< [array([5, 6]), array([1])]
+		"""
+		self.refresh()
+
+		points = np.asarray(points, dtype=np.float64).reshape(-1, self.dimension)
+		radius = np.broadcast_to(np.asarray(r, dtype=np.float64), len(points))
+		chunk = lambda queries, record: self.radius_chunk(points[queries], radius[queries], sort, record)
+		return self.run_batched("radius_query_many", chunk, len(points), workers, csr)
+
+	def radius_chunk(self, points, radius, sort = False, record = None):
+		"""
+		Internal method that runs the radius queries of the given points on
+		all trees, returns the amount of keys per point and the keys ordered
+		by point (and by distance with sort).
+		"""
+		results = [(tree,) + tree.traverse_radius(points, radius * radius, record) for tree in self.trees()]
+		queries = np.concatenate([queries for tree, queries, found in results])
+		keys = np.concatenate([tree.keys[found] for tree, queries, found in results])
+
+		if sort:
+			delta = np.concatenate([tree.points[found] for tree, queries, found in results]) - points[queries]
+			order = np.lexsort(((delta * delta).sum(axis=1), queries))
+		else:
+			order = np.argsort(queries, kind="stable")
+		return np.bincount(queries, minlength=len(points)), keys[order]
+
+	def traverse_radius(self, points, radius2, record = None):
+		"""
+		Internal method used for the radius queries, returns the (point,
+		position) pairs of the matches in this tree as two arrays, radius2
+		holds the squared radius per point. A cell intersects the circle
+		when its closest corner is within the radius and lies inside it
+		when its furthest corner is.
+		"""
+		def classify(queries, cell_lower, cell_upper):
+			query, limit = points[queries], radius2[queries]
+			near = np.maximum(np.maximum(cell_lower - query, query - cell_upper), 0)
+			far = np.maximum(np.abs(query - cell_lower), np.abs(cell_upper - query))
+			return (near * near).sum(axis=1) <= limit, (far * far).sum(axis=1) <= limit
+
+		def within(queries, elements):
+			delta = elements - points[queries]
+			return (delta * delta).sum(axis=1) <= radius2[queries]
+
+		return self.traverse_cells(len(points), classify, within, record)
+
+	def closest(self, point, k = 1):
+		"""
+		Returns the k unique keys closest to the given point and their
+		(euclidean) distances, both ordered by increasing distance.
+
+		The search first descends to the leaf containing the point, and then
+		backtracks into sibling subtrees, but only when the BoundingBox of the
+		sibling's cell is closer than the current k-th best distance.
+
+		:param point: the query point, one coordinate per field
+		:param k	: the amount of neighbours to return
+
+		:Example:
+		>>> print(tree.closest([7,2], k = 2))
+		<<< (array([6, 5]), array([0.        , 1.41421356]))
+		"""
+		self.refresh()
+
+		record = self.stats.begin("closest") if self.stats is not None else None
+		point = np.asarray(point, dtype=np.float64).reshape(self.dimension)
+		if self.cache is not None:
+			self.cache.validate(self.version())
+			key = ("closest", k) + tuple(point.tolist())
+			entry = self.cache.get(key)
+			if entry is not None:
+				if record is not None:
+					record["cached"] = 1
+					self.stats.end(record, len(entry[0]))
+				return entry[0].copy(), entry[1].copy()
+
+		heap = []
+		if k > 0:
+			for tree in self.trees():
+				tree.traverse_closest(point, k, heap, 0, tree.lower, tree.upper, record)
+
+		ordered = sorted((-dist, key) for dist, key in heap)
+		keys = np.array([key for dist, key in ordered], dtype=np.int64)
+		distances = np.sqrt(np.array([dist for dist, key in ordered], dtype=np.float64))
+		if self.cache is not None:
+			self.cache.put(key, (keys.copy(), distances.copy()))
+		if record is not None:
+			self.stats.end(record, len(keys))
+		return keys, distances
+
+	def traverse_closest(self, point, k, heap, node, lower, upper, record = None):
+		"""
+		Internal method used for the k nearest neighbour search.
+
+		The heap holds the best (negated squared distance, key) pairs found
+		so far, so heap[0] is always the current k-th best candidate. The
+		child containing the point is visited first, the other child only if
+		its cell (lower, upper) could still contain a closer point.
+		"""
+		if record is not None:
+			record["nodes"] += 1
+
+		if self.leaf[node]:
+			start, end = self.start[node], self.end[node]
+			if record is not None:
+				record["leaves"] += 1
+				record["elements"] += int(end - start)
+			delta = self.points[start:end] - point
+			dist = np.sum(delta * delta, axis=1)
+
+			# only consider elements that improve on the k-th best
+			candidates = np.arange(len(dist))
+			if self.alive is not None:
+				candidates = candidates[self.alive[start:end]]
+			if len(heap) == k:
+				candidates = candidates[dist[candidates] < -heap[0][0]]
+			if len(candidates) > k:
+				candidates = candidates[np.argpartition(dist[candidates], k - 1)[:k]]
+
+			for c in candidates:
+				if len(heap) < k:
+					heapq.heappush(heap, (-dist[c], int(self.keys[start + c])))
+				elif dist[c] < -heap[0][0]:
+					heapq.heapreplace(heap, (-dist[c], int(self.keys[start + c])))
+			return
+
+		axis = self.axis[node]
+		split = self.split[node]
+
+		left_upper, right_lower = upper.copy(), lower.copy()
+		left_upper[axis] = split
+		right_lower[axis] = split
+
+		children = [(2 * node + 1, lower, left_upper), (2 * node + 2, right_lower, upper)]
+		if point[axis] >= split:
+			children.reverse()
+
+		for child, child_lower, child_upper in children:
+			delta = np.maximum(np.maximum(child_lower - point, point - child_upper), 0)
+			if len(heap) < k or np.dot(delta, delta) < -heap[0][0]:
+				self.traverse_closest(point, k, heap, child, child_lower, child_upper, record)
+
+	def closest_many(self, points, k = 1):
+		"""
+		Returns the k closest unique keys and their (euclidean) distances for
+		every point in a (m, dimension) matrix, as two (m, k) matrices where each row
+		is ordered by increasing distance. When the tree holds less than k
+		elements the remaining keys are -1 and their distances inf.
+
+		The queries are walked through the tree together, in chunks of
+		CLOSEST_CHUNK queries, in rounds: in every round each query takes the
+		closest cell it still has to visit, descends from it to a leaf on
+		the query's side and scans that leaf. Like closest the k-th best
+		distance tightens after every leaf and the cells further away are
+		dropped, while every step works on all queries of a chunk at once.
+
+		:param points	: (m, dimension) matrix of query points
+		:param k		: the amount of neighbours per point
+
+		:Example:
+		>>> keys, distances = tree.closest_many([[7,2], [3,3]], k = 2)
+		>>> print(keys)
+		<<< [[6 5]
+			 [1 2]]
+		"""
+		self.refresh()
+
+		points = np.asarray(points, dtype=np.float64).reshape(-1, self.dimension)
+		best_keys = np.full((len(points), k), -1, dtype=np.int64)
+		best_dist = np.full((len(points), k), np.inf)
+
+		record = self.stats.begin("closest_many", len(points)) if self.stats is not None else None
+		if len(points) > 0 and k > 0:
+			for tree in self.trees():
+				tree.traverse_closest_many(points, best_keys, best_dist, record)
+
+		if record is not None:
+			self.stats.end(record, np.count_nonzero(best_keys >= 0))
+		return best_keys, np.sqrt(best_dist)
+
+	def traverse_closest_many(self, points, best_keys, best_dist, record = None):
+		"""
+		Internal method used for the batched k nearest neighbour search,
+		best_keys and best_dist hold the current k best candidates (ordered)
+		per query and are updated in place. The queries are handled in
+		chunks, so the memory is bounded by the chunk size.
+		"""
+		if len(self.keys) == 0:
+			return
+
+		for first in range(0, len(points), KDTree.CLOSEST_CHUNK):
+			chunk = slice(first, first + KDTree.CLOSEST_CHUNK)
+			self.closest_rounds(points[chunk], best_keys[chunk], best_dist[chunk], record)
+
+	def closest_rounds(self, points, best_keys, best_dist, record = None):
+		"""
+		Internal method that runs the best first search of closest_many for
+		a chunk of queries.
+
+		Every query has a frontier of (node, cell) pairs still to visit. In
+		every round each query takes the pair with the closest cell and
+		descends to a leaf, always into the child on the query's side, the
+		other children join the frontier. Subtrees of at most k elements
+		are scanned as a whole instead, so every round can fill the k best.
+		After the scans the pairs further than the k-th best of their query
+		are dropped.
+		"""
+		k = best_dist.shape[1]
+		count = len(points)
+		queries = np.arange(count)
+		nodes = np.zeros(count, dtype=np.int64)
+		lower, upper = np.tile(self.lower, (count, 1)), np.tile(self.upper, (count, 1))
+		dist = KDTree.cell_distance(points, lower, upper)
+
+		while True:
+			keep = dist < best_dist[queries, -1]
+			queries, nodes, lower, upper, dist = queries[keep], nodes[keep], lower[keep], upper[keep], dist[keep]
+			if len(queries) == 0:
+				break
+
+			# take the closest pair of every query out of the frontier
+			closest = np.full(count, np.inf)
+			np.minimum.at(closest, queries, dist)
+			candidates = np.nonzero(dist == closest[queries])[0]
+			chosen = candidates[np.unique(queries[candidates], return_index=True)[1]]
+			rest = np.ones(len(queries), dtype=bool)
+			rest[chosen] = False
+			query, node, cell_lower, cell_upper = queries[chosen], nodes[chosen], lower[chosen], upper[chosen]
+			frontier = [(queries[rest], nodes[rest], lower[rest], upper[rest], dist[rest])]
+
+			# descend to the leaves, the children on the far side join the frontier
+			leaf_queries, leaves = [], []
+			while len(node) > 0:
+				if record is not None:
+					record["nodes"] += len(node)
+				leaf = self.leaf[node] | (self.end[node] - self.start[node] <= k)
+				leaf_queries.append(query[leaf])
+				leaves.append(node[leaf])
+				query, node, cell_lower, cell_upper = query[~leaf], node[~leaf], cell_lower[~leaf], cell_upper[~leaf]
+
+				right = points[query, self.axis[node]] >= self.split[node]
+				children, child_lower, child_upper = self.split_cells(node, cell_lower, cell_upper)
+				index = np.arange(len(node))
+				near, far = np.where(right, index + len(node), index), np.where(right, index, index + len(node))
+				frontier.append((query, children[far], child_lower[far], child_upper[far],
+								 KDTree.cell_distance(points[query], child_lower[far], child_upper[far])))
+				node, cell_lower, cell_upper = children[near], child_lower[near], child_upper[near]
+
+			self.scan_leaves(points, np.concatenate(leaf_queries), np.concatenate(leaves), best_keys, best_dist, record)
+			queries, nodes, lower, upper, dist = (np.concatenate(arrays) for arrays in zip(*frontier))
+
+	@staticmethod
+	def cell_distance(points, lower, upper):
+		"""
+		Internal method that returns the squared distance of every point to
+		the cell with the corresponding lower and upper corners.
+		"""
+		delta = np.maximum(np.maximum(lower - points, points - upper), 0)
+		return (delta * delta).sum(axis=1)
+
+	def scan_leaves(self, points, queries, leaves, best_keys, best_dist, record = None):
+		"""
+		Internal method that merges the elements of (the subtree of) leaves[i]
+		into the k best candidates of query queries[i]. The (query, leaf) pairs
+		are handled in chunks to bound the size of the distance matrices.
+		"""
+		if len(queries) == 0:
+			return
+
+		k = best_dist.shape[1]
+		starts = self.start[leaves]
+		sizes = self.end[leaves] - starts
+		if record is not None:
+			record["leaves"] += len(leaves)
+			record["elements"] += int(sizes.sum())
+		width = int(sizes.max())
+		if width == 0:
+			return
+
+		offsets = np.arange(width)
+		step = max(1, 2 ** 20 // width)
+		for i in range(0, len(queries), step):
+			chunk = queries[i:i + step]
+			valid = offsets < sizes[i:i + step, np.newaxis]
+			index = np.where(valid, starts[i:i + step, np.newaxis] + offsets, 0)
+			if self.alive is not None:
+				valid &= self.alive[index]
+
+			delta = self.points[index] - points[chunk, np.newaxis, :]
+			dist = (delta * delta).sum(axis=2)
+			valid &= dist < best_dist[chunk, -1, np.newaxis]
+			pair, column = np.nonzero(valid)
+			if len(pair) == 0:
+				continue
+
+			# merge the candidates with the current best per query
+			updated, inverse = np.unique(chunk[pair], return_inverse=True)
+			group = np.concatenate((np.repeat(np.arange(len(updated)), k), inverse))
+			dist = np.concatenate((best_dist[updated].ravel(), dist[pair, column]))
+			keys = np.concatenate((best_keys[updated].ravel(), self.keys[index[pair, column]]))
+
+			order = np.lexsort((dist, group))
+			first = np.searchsorted(group[order], np.arange(len(updated)))
+			order = order[first[:, np.newaxis] + np.arange(k)]
+			best_dist[updated] = dist[order]
+			best_keys[updated] = np.where(np.isinf(dist[order]), -1, keys[order])
+
+
+	def save(self, path):
+		"""
+		Saves the KDTree to a binary file, see binaryfile.BinaryFile, containing
+		the node arrays, the key permutation, the root BoundingBox, the
+		forest of inserted elements and the fingerprint (count and checksum)
+		of the keys and coordinates the trees hold.
+
+		:param path: the file name
+
+		:Example:
+		>>> tree.save("points.kdt")
+		"""
+		self.compact(1.0)
+		elements = [tree.elements() for tree in self.trees()]
+		source = KDTree.fingerprint(np.concatenate([keys for keys, points in elements]), np.concatenate([points for keys, points in elements]))
+
+		meta = {"source" : source, "options" : self.options, "trees" : []}
+		arrays = []
+		for slot, tree in enumerate([self] + self.forest):
+			if tree is not None:
+				bounds = np.column_stack((tree.lower, tree.upper)).tolist()
+				meta["trees"].append({"slot" : slot, "max_depth" : tree.max_depth, "bounding_box" : bounds})
+				arrays.extend(("%i.%s" % (slot, name), getattr(tree, name)) for name in KDTree.ARRAYS)
+
+		bf.BinaryFile.write(path, KDTree.MAGIC, meta, arrays)
+
+	@staticmethod
+	def fingerprint(keys, points):
+		"""
+		Internal method that identifies a set of elements by their amount
+		and a crc32 checksum over the keys and the coordinates of every
+		field, in order of key.
+		"""
+		order = np.argsort(keys, kind="stable")
+		crc = zlib.crc32(memoryview(np.ascontiguousarray(keys[order], dtype=np.int64)).cast("B"))
+		for axis in range(points.shape[1]):
+			crc = zlib.crc32(memoryview(np.ascontiguousarray(points[order, axis], dtype=np.float64)).cast("B"), crc)
+		return {"rows" : len(keys), "checksum" : crc}
+
+	@staticmethod
+	def load(path, db = None, mmap = True):
+		"""
+		Loads a KDTree saved by save without any recomputation, with mmap the
+		arrays are memory-mapped (see Database.open). When the Database is
+		given, the fingerprint of its records (keys and indexed fields) is
+		checked against the fingerprint of the saved elements, a ValueError
+		is raised for a stale index.
+
+		:param path: the file name
+		:param db  : optional Database to verify the index against
+		:param mmap: memory-map the arrays instead of reading them
+
+		:Example:
+		>>> tree = KDTree.load("points.kdt", database)
+		"""
+		meta, arrays = bf.BinaryFile.read(path, KDTree.MAGIC, mmap)
+
+		if db is not None:
+			fields = meta["options"].get("fields", ["x", "y"])
+			points = np.column_stack([db.column(field) for field in fields]).astype(np.float64, copy=False)
+			if meta["source"] != KDTree.fingerprint(db.keys(), points):
+				raise ValueError('The index %s is stale, it was built on a different Database.' % path)
+
+		trees = {}
+		for description in meta["trees"]:
+			tree = KDTree.__new__(KDTree)
+			tree.init_state(db, meta["options"] if description["slot"] == 0 else {})
+			tree.options = meta["options"]
+			tree.max_depth = description["max_depth"]
+			for name in KDTree.ARRAYS:
+				setattr(tree, name, arrays["%i.%s" % (description["slot"], name)])
+			bounds = np.array(description["bounding_box"], dtype=np.float64)
+			tree.lower, tree.upper = bounds[:, 0], bounds[:, 1]
+			tree.dimension = len(bounds)
+			tree.split_rule = tree.options.get("split-rule", "alternate")
+			trees[description["slot"]] = tree
+
+		main = trees.pop(0)
+		main.forest = [trees.get(slot) for slot in range(1, max(trees, default=0) + 1)]
+		return main
 
 
 if __name__ == '__main__':
@@ -217,17 +1390,56 @@ if __name__ == '__main__':
 	database.insert_iterable(data)	
 
 	tree = KDTree(database,{"max-depth":3})
-	for node in tree.storage:
-		print(node)
+	print(tree.axis)
+	print(tree.split)
+	print(tree.start, tree.end)
+	print(tree.keys)
 
 	print(tree.bounding_box())
 
 	for k,v in tree.partitions().items():
 		print(k,len(v))
+	print(tree.partitions(2))
 	
-	bbox = bb.BoundingBox(1,2,1,2)
+	bbox = bb.BoundingBox(1,5,1,4)
 	print(tree.rquery(bbox))
 	print (database.query(tree.rquery(bbox)))
+	print(tree.rquery_many([bbox, bb.BoundingBox(2,6,4,6)]))
+	print(tree.rquery_many([bbox, bb.BoundingBox(2,6,4,6)], csr = True))
 
 	print("closest")
-	print(tree.closest([7,2]))
\ No newline at end of file
+	print(tree.closest([7,2]))
+	print(tree.closest([7,2], k = 2))
+	print(tree.closest_many([[7,2], [3,3]], k = 2))
+
+	print("radius")
+	print(tree.radius_query([7,2], 2))
+	print(tree.radius_query([7,2], 2, sort = True))
+	print(tree.radius_query_many([[7,2], [3,3]], 2))
+
+	with tree.trace() as stats:
+		tree.rquery(bbox)
+		tree.closest([7,2], k = 2)
+	print(list(stats.records))
+
+	cached = KDTree(database,{"max-depth":3, "cache-bytes":2**20})
+	print(cached.rquery(bbox), cached.rquery(bb.BoundingBox(1.001,5,1,4)), cached.closest([7,2], k = 2))
+	database.update_field(1,"x",4)
+	print(cached.rquery(bbox), cached.cache.info())
+	database.update_field(1,"x",2)
+
+	tree.save("example.kdt")
+	loaded = KDTree.load("example.kdt", database)
+	print(loaded.rquery(bbox), loaded.closest([7,2], k = 2))
+	os.remove("example.kdt")
+
+	print("insert")
+	tree.insert(database.insert_iterable([[3,5], [6,6]]))
+	print(tree.closest([6,5], k = 2))
+	print(tree.rquery(bb.BoundingBox(2,6,4,6)))
+
+	print("delete")
+	database.delete([6, 8])
+	print(tree.closest([6,5], k = 2))
+	tree.compact()
+	print(tree.rquery(bb.BoundingBox(2,9,1,7)))
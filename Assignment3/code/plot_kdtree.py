@@ -1,4 +1,5 @@
 import argparse
+import os
 import boundingbox as bb
 import database as db
 import data_loader as dl
@@ -22,8 +23,11 @@ if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description = 'KDTree plotting program.')
 
 	parser.add_argument('--filename', help='file containing spatial information.',type=str)
+	parser.add_argument('--database', help='binary database file, created from the loaded data when missing.',type=str)
+	parser.add_argument('--index', help='binary KDTree index file, created from the database when missing, stale or built with other options.',type=str)
 	parser.add_argument('--max-depth', help='the maximum depth of the KDTree.',type=int,default=3)
 	parser.add_argument('--max-elements', help='the maximum of elements in a KDTree leave.',type=int, default=1000)
+	parser.add_argument('--build-workers', help='the amount of processes used for building the KDTree.',type=int, default=1)
 	parser.add_argument('--bbox-depth', help='display the bounding-boxes at specific depth.',type=int,default=2)
 	parser.add_argument('--plot', help='choose what to plot (kdtree-bb,storage)',type=str,default="kdtree-bb")
 	parser.add_argument('--range-query', help='bbox range query, "1 2; 3 4"',type=str)	
@@ -40,22 +44,42 @@ if __name__ == '__main__':
 	fields = ["x","y"]
 	if args.quadtree:
 		fields.append("quad")
-	dtb =  db.Database(fields)
-	field_idx = dtb.fields()
+	if args.database and os.path.exists(args.database):
+		dtb = db.Database.open(args.database)
+	else:
+		dtb =  db.Database(fields)
 	
-	# Load the data
-	data_loader = dl.DataLoader()
-	data_loader.load(args,dtb)
+		# Load the data
+		data_loader = dl.DataLoader()
+		data_loader.load(args,dtb)
+
+		if args.database:
+			dtb.save(args.database)
+	field_idx = dtb.fields()
 
-	# Create KDTree
-	tree = kd.KDTree(dtb, {'max-depth' : args.max_depth, 'max-elements' : args.max_elements})
+	# Create KDTree, a saved index is only used when it was built with the same options
+	options = {'max-depth' : args.max_depth, 'max-elements' : args.max_elements}
+	tree = None
+	if args.index and os.path.exists(args.index):
+		try:
+			tree = kd.KDTree.load(args.index, dtb)
+		except ValueError:
+			tree = None
+		if tree is not None and any(tree.options.get(name) != value for name, value in options.items()):
+			tree = None
+
+	if tree is None:
+		options['build-workers'] = args.build_workers
+		tree = kd.KDTree(dtb, options)
+		if args.index:
+			tree.save(args.index)
 
 	plotter = pl.Plotter(tree,dtb,args)
 
 
 	# Testing: Implementing the QuadTree
 	if args.quadtree:
-		quadtree = qt.QuadTree(tree.bounding_box(), args.quadtree)
+		quadtree = qt.QuadTree(tree.bounding_box(), args.quadtree, implicit = True)
 		if args.quadshow:
 			plotter.add_quadtree(quadtree)
 
@@ -65,30 +89,17 @@ if __name__ == '__main__':
 
 		# Step 1 query and fetch		
 		closest_query = np.fromstring(args.closest,dtype=float, sep=' ')
-		closest_records = dtb.query(tree.closest(closest_query))
-
-		# Step 2 compare found geometry with closest_point	
-		geometries= [ [x[field_idx["x"]],x[field_idx["y"]] ] for x in closest_records]
-		distances = [np.linalg.norm(closest_query - geom) for geom in geometries]
-		ordered = np.argsort(distances)
+		closest_keys, closest_distances = tree.closest(closest_query)
+		closest_record = dtb.query(int(closest_keys[0]))
+		geometry = [closest_record[field_idx["x"]], closest_record[field_idx["y"]]]
 		
-		# Step 3 plot search and result point
-		plotter.add_closest_query(closest_query,geometries[ordered[0]])		
+		# Step 2 plot search and result point
+		plotter.add_closest_query(closest_query,geometry)		
 
 		
 	# Using the QuadTree depth to subsample the KDTree		
 	if args.quadtree:
-		for element in dtb.keys():
-			dtb.update_field(element,'quad',quadtree.depth)
-		
-		for quad_lvl, bb_list in sorted(quadtree.quads.items(), key=lambda x: x[0], reverse=True):
-			for bb in bb_list: 
-				center = bb.centroid()
-				closest_indices = tree.closest(center)
-				closest_list = dtb.query(closest_indices)
-				closest_idx = np.argmin([((center[0] - element[1])**2 + (center[1] - element[2])**2) for element in closest_list])
-
-				dtb.update_field(closest_indices[closest_idx], 'quad', quad_lvl)
+		qt.assign_quad_levels(dtb, tree, quadtree.depth)
 
 	plotter.plot()
 
@@ -56,15 +56,10 @@ class Plotter:
 		plt.show()
 	
 	def plot_storage(self):
-		index = []
-		elements = []
-		for elem in self.kdtree.storage:
-			if "index" in elem:
-				num_elem = 0
-				if "elements" in  elem:
-					num_elem = len(elem["elements"])
-				index.append(elem["index"])
-				elements.append(num_elem)
+		tree = self.kdtree
+		used = np.flatnonzero(tree.axis >= 0)
+		index = used + 1
+		elements = np.where(tree.leaf[used], tree.end[used] - tree.start[used], 0)
 		
 		plt.plot(index,elements)
 		self.ax.set_xlabel("Storage index")
@@ -75,28 +70,26 @@ class Plotter:
 	def plot_tree(self):
 
 		# 1: plot all datapoints
-		keys = self.db.keys()
-		data = np.asarray(self.db.query(keys))	
+		x = self.db.column("x")
+		y = self.db.column("y")
 		
-		# @todo change database info
-		column = {"key":0,"x":1,"y":2}
-		
-		if self.args.quadlevel:
-			column["quad"] = 3
-			data = data[data[:,column["quad"]] < self.args.quadlevel]
+		if self.args.quadlevel and "quad" in self.db.fields():
+			selected = self.db.where("quad", "<", self.args.quadlevel)
+			x = self.db.column("x", selected)
+			y = self.db.column("y", selected)
 
 		markersize = 0.5		
-		if len(data) < 100:
+		if len(x) < 100:
 			markersize = 4	
 
-		plt.plot(data[:,column["x"]], data[:,column["y"]], 'ko', markersize=markersize)
+		plt.plot(x, y, 'ko', markersize=markersize)
 
 		# 2: plot all boundingboxes/partitions
-		bboxes = self.kdtree.partitions()
+		bboxes = self.kdtree.partitions(self.args.bbox_depth)
 		patches = []
 
-		for b in bboxes[self.args.bbox_depth]:
-			rect = plt.Rectangle(b.lower_left(), b.width(),b.height(), ec="none",edgecolor='black')
+		for (lx, ly), w, h in zip(bboxes.lower_left(), bboxes.width(), bboxes.height()):
+			rect = plt.Rectangle((lx, ly), w, h, ec="none",edgecolor='black')
 			patches.append(rect)
 
 		# 3: show range query
@@ -105,13 +98,7 @@ class Plotter:
 			patches.append(plt.Rectangle(rq.lower_left(),rq.width(),rq.height()))
 			
 			rkeys = self.kdtree.rquery(rq)
-			NN = np.asarray(self.db.query(rkeys))
-			plt.plot(NN[:,column["x"]], NN[:,column["y"]], 'rs', markersize=markersize + 4)	
-
-			for point in NN:
-				if rq.within(point[1],0):
-					if rq.within(point[2],1):
-						plt.plot([point[1]],[point[2]], 'bs', markersize=markersize + 4)	
+			plt.plot(self.db.column("x", rkeys), self.db.column("y", rkeys), 'bs', markersize=markersize + 4)	
 
 		colors = np.linspace(0, 100, len(patches) + 1)
 		collection = PatchCollection(patches, cmap=plt.cm.jet, alpha=0.3)
@@ -125,11 +112,11 @@ class Plotter:
 	
 
 	def plot_quadtree(self):
-		qt_depth = max(self.quadtree.quads.keys())
+		qt_depth = self.quadtree.depth - 1
 			
 		patches = []
-		for q in self.quadtree.quads[qt_depth]:
-			rect = plt.Rectangle(q.lower_left(), q.width(),q.height())
+		for q in self.quadtree.cells(qt_depth):
+			rect = plt.Rectangle((q[0,0], q[1,0]), q[0,1] - q[0,0], q[1,1] - q[1,0])
 			patches.append(rect)
 		collection = PatchCollection(patches)
 		collection.set_edgecolor([0,0,0])
@@ -1,5 +1,6 @@
 import boundingbox as bb
 import math
+import numpy as np
 
 class QuadTree:
 	"""
@@ -21,19 +22,31 @@ class QuadTree:
 	
 	Generation of the QuadTree is slow, using it to reduce your dataset it fast.
 
+	An implicit QuadTree does not generate self.quads, its cells are computed
+	on demand from (level, ix, iy), where ix and iy count the cells from the
+	lower left corner: see cell and cells. Construction is O(1) and memory is
+	only used for the requested level.
+
 	"""
-	def __init__(self,bbox, depth):
+	def __init__(self,bbox, depth, implicit = False):
 		"""
 		Create a new QuadTree instance.
-		:param bbox: the initial BoundingBox
-		:param depth: the depth of the QuadTree
+		:param bbox		: the initial BoundingBox
+		:param depth	: the depth of the QuadTree
+		:param implicit	: compute the cells on demand instead of generating them
 
 		:Example:
 		>>> bbox = bb.BoundingBox(2,9,1,7)
 		>>> qt = QuadTree(bbox, 2)
+		>>> qt = QuadTree(bbox, 10, implicit = True)
 		"""
 		self.quads = {}
 		self.depth = depth
+		self.bbox = bbox
+		self.implicit = implicit
+
+		if implicit:
+			return
 
 		for x in range(depth):
 			self.quads[x]= []
@@ -56,10 +69,10 @@ class QuadTree:
 
 		cen_x, cen_y = bbox.centroid()
 
-		NW = bb.BoundingBox(bbox.data[0][0], cen_x, cen_y, bbox.data[1][1])
-		NE = bb.BoundingBox(cen_x, bbox.data[0][1], cen_y, bbox.data[1][1])
-		SW = bb.BoundingBox(bbox.data[0][0], cen_x, bbox.data[1][0], cen_y)
-		SE = bb.BoundingBox(cen_x, bbox.data[0][1], bbox.data[1][0], cen_y)		
+		NW = bb.BoundingBox(bbox.min_x, cen_x, cen_y, bbox.max_y)
+		NE = bb.BoundingBox(cen_x, bbox.max_x, cen_y, bbox.max_y)
+		SW = bb.BoundingBox(bbox.min_x, cen_x, bbox.min_y, cen_y)
+		SE = bb.BoundingBox(cen_x, bbox.max_x, bbox.min_y, cen_y)
 
 		self.quads[depth] += [NW, NE, SW, SE]
 		self.recurse(NW, depth+1)
@@ -119,6 +132,307 @@ class QuadTree:
 		"""
 		return self.quads
 
+	def cell(self, level, ix, iy):
+		"""
+		Returns the BoundingBox of a single cell, ix and iy count the
+		cells from the lower left corner (0 <= ix, iy < 2**level).
+
+		:Example:
+		>>> print(qt.cell(1, 1, 0))
+		<<< [[5.5 9. ]
+			 [1.  4. ]]
+		"""
+		n = 2 ** level
+		x = self.bbox.side(0)
+		y = self.bbox.side(1)
+		width = (x[1] - x[0]) / n
+		height = (y[1] - y[0]) / n
+		return bb.BoundingBox(x[0] + ix * width, x[0] + (ix + 1) * width, y[0] + iy * height, y[0] + (iy + 1) * height)
+
+	def cells(self, level):
+		"""
+		Returns all the cells of a level as a (4**level, 2, 2) numpy array,
+		each cell is stored like BoundingBox.data. Implicit QuadTrees compute
+		them in a single vectorized step, ordered row by row from the lower
+		left corner (index = iy * 2**level + ix).
+
+		:Example:
+		>>> print(qt.cells(1).shape)
+		<<< (4, 2, 2)
+		"""
+		if level < 0 or level >= self.depth:
+			raise ValueError('The level must be in [0, %i).' % self.depth)
+
+		if not self.implicit:
+			return np.array([q.data for q in self.quads[level]])
+
+		n = 2 ** level
+		xs = np.linspace(self.bbox.min_x, self.bbox.max_x, n + 1)
+		ys = np.linspace(self.bbox.min_y, self.bbox.max_y, n + 1)
+		iy, ix = np.divmod(np.arange(n * n), n)
+
+		cells = np.empty((n * n, 2, 2))
+		cells[:,0,0] = xs[ix]
+		cells[:,0,1] = xs[ix + 1]
+		cells[:,1,0] = ys[iy]
+		cells[:,1,1] = ys[iy + 1]
+		return cells
+
+	def centroids(self, level):
+		"""
+		Returns the centers of all the cells of a level as a
+		(4**level, 2) numpy array, in the same order as cells.
+
+		:Example:
+		>>> print(qt.centroids(0))
+		<<< [[5.5 4. ]]
+		"""
+		cells = self.cells(level)
+		return (cells[:,:,0] + cells[:,:,1]) / 2.0
+
+class PointQuadTree:
+	"""
+	A point-region QuadTree holding the points of a Database.
+
+	Every point gets the Morton (Z-order) code of its cell at the deepest
+	level (depth - 1), computed for all points in one vectorized pass, and
+	the keys are sorted once on these codes. Because the Morton code of a
+	cell is a prefix of the codes of all its sub cells, every cell at every
+	level is a contiguous range of the sorted keys:
+
+		level l, cell (ix, iy) -> codes in [m << s, (m + 1) << s)
+			where m = morton(ix, iy) and s = 2 * (depth - 1 - l)
+
+	The cells are those of an implicit QuadTree on the points' MBR, ix and
+	iy count the cells from the lower left corner.
+
+	:Example:
+	>>> tree = PointQuadTree(database, 3)
+	>>> print(tree.cell_keys(1, 1, 0))
+	<<< [6 5]
+	"""
+	MAX_DEPTH = 32
+
+	def __init__(self, db, depth):
+		"""
+		Create a new PointQuadTree instance.
+		:param db	: Database with fields x,y
+		:param depth: the depth of the QuadTree (at most 32)
+
+		:Example:
+		>>> tree = PointQuadTree(database, 3)
+		"""
+		if depth < 1 or depth > PointQuadTree.MAX_DEPTH:
+			raise ValueError('The depth must be in [1, %i].' % PointQuadTree.MAX_DEPTH)
+
+		self.db = db
+		self.deletions = db.deletions
+		self.depth = depth
+
+		keys = db.keys()
+		points = np.column_stack((db.column("x"), db.column("y"))).astype(np.float64, copy=False)
+		self.bbox = bb.BoundingBox.from_dataset(points,0,1)
+		self.quadtree = QuadTree(self.bbox, depth, implicit = True)
+
+		ix, iy = self.locate(points, depth - 1)
+		codes = PointQuadTree.morton(ix, iy)
+		order = np.argsort(codes, kind="stable")
+
+		self.codes = codes[order]
+		self.keys = keys[order]
+		self.points = points[order]
+
+	@staticmethod
+	def spread(v):
+		"""
+		Spreads the lower 32 bits of v over the even bits.
+		"""
+		v = np.asarray(v).astype(np.uint64) & np.uint64(0x00000000FFFFFFFF)
+		v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+		v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+		v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+		v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+		v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+		return v
+
+	@staticmethod
+	def compact(v):
+		"""
+		Inverse of spread, gathers the even bits of v.
+		"""
+		v = np.asarray(v).astype(np.uint64) & np.uint64(0x5555555555555555)
+		v = (v | (v >> np.uint64(1))) & np.uint64(0x3333333333333333)
+		v = (v | (v >> np.uint64(2))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+		v = (v | (v >> np.uint64(4))) & np.uint64(0x00FF00FF00FF00FF)
+		v = (v | (v >> np.uint64(8))) & np.uint64(0x0000FFFF0000FFFF)
+		v = (v | (v >> np.uint64(16))) & np.uint64(0x00000000FFFFFFFF)
+		return v.astype(np.int64)
+
+	@staticmethod
+	def morton(ix, iy):
+		"""
+		Returns the Morton codes of the cells (ix, iy), by interleaving
+		the bits of ix (even bits) and iy (odd bits).
+
+		:Example:
+		>>> print(PointQuadTree.morton([1, 0, 1], [0, 1, 1]))
+		<<< [1 2 3]
+		"""
+		return PointQuadTree.spread(ix) | (PointQuadTree.spread(iy) << np.uint64(1))
+
+	def locate(self, points, level):
+		"""
+		Returns the cell (ix, iy) at the given level for every point in a
+		(m, 2) matrix, points outside of the QuadTree are clipped to the
+		closest cell.
+
+		:Example:
+		>>> print(tree.locate([[7, 2], [2, 3]], 1))
+		<<< (array([1, 0]), array([0, 0]))
+		"""
+		points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+		n = 2 ** level
+
+		cells = []
+		for axis in range(2):
+			lo, hi = self.bbox.side(axis)
+			scale = n / (hi - lo) if hi > lo else 0.0
+			cells.append(np.clip(np.floor((points[:,axis] - lo) * scale), 0, n - 1).astype(np.int64))
+		return cells[0], cells[1]
+
+	def cell_range(self, level, ix, iy):
+		"""
+		Internal method that returns the range [start, end) of the sorted
+		keys belonging to the cell (ix, iy) at the given level.
+		"""
+		shift = np.uint64(2 * (self.depth - 1 - level))
+		code = PointQuadTree.morton(ix, iy)
+		start = np.searchsorted(self.codes, code << shift, "left")
+		end = np.searchsorted(self.codes, (code + np.uint64(1)) << shift, "left")
+		return int(start), int(end)
+
+	def alive(self, keys):
+		"""
+		Internal method that removes keys deleted from the Database
+		since the PointQuadTree was built.
+		"""
+		if self.db.deletions == self.deletions:
+			return keys
+		return keys[self.db.contains(keys)]
+
+	def cell_keys(self, level, ix, iy):
+		"""
+		Returns the keys of the points in the cell (ix, iy) at the given level.
+
+		:Example:
+		>>> print(tree.cell_keys(0, 0, 0))
+		<<< [1 6 5 2 4 3]
+		"""
+		start, end = self.cell_range(level, ix, iy)
+		return self.alive(self.keys[start:end])
+
+	def counts(self, level):
+		"""
+		Returns the amount of points per cell at the given level as a
+		(2**level, 2**level) matrix, indexed as counts[iy, ix].
+
+		:Example:
+		>>> print(tree.counts(1))
+		<<< [[1 2]
+			 [2 1]]
+		"""
+		if level < 0 or level >= self.depth:
+			raise ValueError('The level must be in [0, %i).' % self.depth)
+
+		n = 2 ** level
+		prefixes = self.codes >> np.uint64(2 * (self.depth - 1 - level))
+		weights = None
+		if self.db.deletions != self.deletions:
+			weights = self.db.contains(self.keys)
+		per_code = np.bincount(prefixes.astype(np.int64), weights, minlength=n * n).astype(np.int64)
+
+		codes = np.arange(n * n, dtype=np.uint64)
+		counts = np.zeros((n, n), dtype=np.int64)
+		counts[PointQuadTree.compact(codes >> np.uint64(1)), PointQuadTree.compact(codes)] = per_code
+		return counts
+
+	def rquery(self, bbox):
+		"""
+		Returns an array of unique keys of the points that fall within
+		(or on the sides of) the provided BoundingBox.
+
+		The cells are visited from the root, cells completely inside the
+		BoundingBox are returned as a whole (a single range of the sorted
+		keys), only the points in the deepest cells on the border of the
+		BoundingBox are tested.
+
+		:param bbox: the BoundingBox that will be searched
+
+		:Example:
+		>>> print(tree.rquery(bb.BoundingBox(1,5,1,4)))
+		<<< [2 1]
+		"""
+		keys = []
+		cells = [(0, 0, 0, 0, len(self.keys))]
+		while cells:
+			level, ix, iy, start, end = cells.pop()
+			if start == end:
+				continue
+
+			box = self.quadtree.cell(level, ix, iy)
+			if not bbox.intersects(box):
+				continue
+
+			if bbox.contains(box):
+				keys.append(self.keys[start:end])
+			elif level == self.depth - 1:
+				keys.append(self.keys[start:end][bbox.within_points(self.points[start:end])])
+			else:
+				# the children are consecutive ranges in morton order
+				shift = np.uint64(2 * (self.depth - 2 - level))
+				first = PointQuadTree.morton(2 * ix, 2 * iy) << shift
+				bounds = np.searchsorted(self.codes[start:end], first + (np.arange(5, dtype=np.uint64) << shift)) + start
+				for child, (dx, dy) in enumerate([(0, 0), (1, 0), (0, 1), (1, 1)]):
+					cells.append((level + 1, 2 * ix + dx, 2 * iy + dy, bounds[child], bounds[child + 1]))
+
+		if len(keys) == 0:
+			return np.array([], dtype=np.int64)
+		return self.alive(np.concatenate(keys))
+
+def assign_quad_levels(db, tree, depth, field = "quad"):
+	"""
+	Assigns every record its quad level (level of detail), for a QuadTree
+	of the given depth on the tree's BoundingBox: the record closest to the
+	center of a cell at level l gets level l (the lowest of these when it
+	is closest to several centers), all the other records get depth.
+	Selecting the records with a quad level < l gives at most one record
+	per cell for the first l levels.
+
+	The closest records for the centers of all levels are found by a single
+	KDTree.closest_many query and the field is written in one go.
+
+	:param db	: the Database
+	:param tree	: a KDTree on the Database
+	:param depth: the depth of the QuadTree
+	:param field: the field the levels are written to
+
+	:Example:
+	>>> assign_quad_levels(database, tree, 5)
+	>>> print(database.where("quad", "<", 2))
+	"""
+	quadtree = QuadTree(tree.bounding_box(), depth, implicit = True)
+	centers = np.concatenate([quadtree.centroids(level) for level in range(depth)])
+	levels = np.concatenate([np.full(4 ** level, level) for level in range(depth)])
+
+	closest_keys, _ = tree.closest_many(centers)
+	closest_keys = closest_keys[:,0]
+	found = closest_keys >= 0
+
+	keys = db.keys()
+	values = np.full(len(keys), depth)
+	np.minimum.at(values, np.searchsorted(keys, closest_keys[found]), levels[found])
+	db.update_column(field, values)
+
 if __name__ == '__main__':
 
 	bbox = bb.BoundingBox(2,9,1,7)
@@ -134,3 +448,17 @@ if __name__ == '__main__':
 		for x in v:
 			print(x.data)
 
+	implicit = QuadTree(bbox, 10, implicit = True)
+	print(implicit.cell(1, 1, 0))
+	print(implicit.cells(9).shape)
+	print(implicit.centroids(0))
+
+	import database as db
+	database = db.Database(["x","y"])
+	database.insert_iterable([[2,3], [5,4], [9,6], [4,7], [8,1], [7,2]])
+	points = PointQuadTree(database, 3)
+	print(PointQuadTree.morton([1, 0, 1], [0, 1, 1]))
+	print(points.locate([[7, 2], [2, 3]], 1))
+	print(points.cell_keys(0, 0, 0), points.cell_keys(1, 1, 0))
+	print(points.counts(1))
+	print(points.rquery(bb.BoundingBox(1,5,1,4)))
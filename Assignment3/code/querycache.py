@@ -0,0 +1,97 @@
+import collections
+
+class QueryCache:
+	"""
+	A least recently used cache for query results, bounded by the memory
+	of the cached numpy arrays, see the cache-bytes option of KDTree.
+
+	Every entry is a tuple of arrays stored under a hashable key. The cache
+	is tied to a version of the data it was filled from: validate clears it
+	as soon as the version changes, so results are never served after the
+	data they were computed on was modified.
+
+	:Example:
+	>>> cache = QueryCache(2**20)
+	>>> cache.validate(1)
+	>>> cache.put(("closest", 1, 7.0, 2.0), (np.array([6]), np.array([0.])))
+	>>> print(cache.get(("closest", 1, 7.0, 2.0)))
+	<<< (array([6]), array([0.]))
+	>>> print(cache.info())
+	<<< {'hits': 1, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'entries': 1, 'bytes': 240, 'max_bytes': 1048576}
+	"""
+	# estimated bytes of the key, tuple and dictionary slot of an entry
+	OVERHEAD = 224
+
+	def __init__(self, max_bytes = 64 * 2**20):
+		"""
+		Create a new QueryCache instance.
+		:param max_bytes: the maximum amount of bytes held by the entries
+		"""
+		self.max_bytes = max_bytes
+		self.entries = collections.OrderedDict()
+		self.bytes = 0
+		self.version = None
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.invalidations = 0
+
+	def validate(self, version):
+		"""
+		Clears the cache when the version of the data differs from the
+		version the entries were computed on.
+		"""
+		if version != self.version:
+			if len(self.entries) > 0:
+				self.invalidations += 1
+			self.clear()
+			self.version = version
+
+	def get(self, key):
+		"""
+		Returns the entry stored under key (marking it as most recently
+		used) or None.
+		"""
+		entry = self.entries.get(key)
+		if entry is None:
+			self.misses += 1
+			return None
+		self.entries.move_to_end(key)
+		self.hits += 1
+		return entry[0]
+
+	def put(self, key, value):
+		"""
+		Stores a tuple of arrays under key, the least recently used entries
+		are evicted until the cache fits in max_bytes. Entries larger than
+		max_bytes are not stored.
+		"""
+		size = sum(array.nbytes for array in value) + QueryCache.OVERHEAD
+		if size > self.max_bytes:
+			return
+
+		if key in self.entries:
+			self.bytes -= self.entries.pop(key)[1]
+		self.entries[key] = (value, size)
+		self.bytes += size
+
+		while self.bytes > self.max_bytes:
+			key, (value, size) = self.entries.popitem(last = False)
+			self.bytes -= size
+			self.evictions += 1
+
+	def info(self):
+		"""
+		Returns the hit, miss, eviction and invalidation counters and the
+		current size of the cache.
+		"""
+		return {"hits" : self.hits, "misses" : self.misses, "evictions" : self.evictions,
+				"invalidations" : self.invalidations, "entries" : len(self.entries),
+				"bytes" : self.bytes, "max_bytes" : self.max_bytes}
+
+	def clear(self):
+		"""
+		Removes all entries, the counters are kept.
+		"""
+		self.entries.clear()
+		self.bytes = 0
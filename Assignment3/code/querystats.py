@@ -0,0 +1,134 @@
+import collections
+import json
+import time
+import numpy as np
+
+class QueryStats:
+	"""
+	Collects counters and wall times of KDTree queries, see KDTree.trace.
+
+	Every query gives a record with:
+		query		: the query method (rquery, rquery_many, radius_query,
+					  radius_query_many, closest, closest_many)
+		queries		: the amount of queries (> 1 for the batched methods)
+		nodes		: the amount of visited nodes ((query, node) pairs when batched)
+		leaves		: the amount of leaves whose elements were scanned
+		elements	: the amount of scanned elements (tested or distance computed)
+		contained	: elements returned as part of a subtree inside the range,
+					  without testing them (range and radius queries)
+		hits		: the amount of returned keys
+		cached		: 1 when the result came from the cache (see the
+					  cache-bytes option of KDTree), otherwise 0. Cached
+					  range queries test all the elements of the rounded
+					  box, so their elements is that amount and contained 0
+		seconds		: the wall time
+	the false positives of a range query are elements - (hits - contained).
+
+	The last max_records records are kept, summary aggregates them per query
+	method with percentiles and log2 histograms. An optional callback is
+	called with every record, e.g. to send them to a log.
+
+	:Example:
+	>>> with tree.trace() as stats:
+	>>>		tree.rquery(bbox)
+	>>> print(stats.records[-1])
+	<<< {'query': 'rquery', 'queries': 1, 'nodes': 7, 'leaves': 2, 'elements': 3, 'contained': 1, 'hits': 2, 'cached': 0, 'seconds': 0.0001}
+	"""
+	COUNTERS = ["queries", "nodes", "leaves", "elements", "contained", "hits", "cached"]
+
+	def __init__(self, callback = None, max_records = 100000):
+		"""
+		Create a new QueryStats instance.
+		:param callback		: optional function called with every record
+		:param max_records	: the amount of records that is kept
+		"""
+		self.callback = callback
+		self.records = collections.deque(maxlen=max_records)
+
+	@staticmethod
+	def counters():
+		"""
+		Returns a dictionary with all counters set to 0
+		"""
+		return dict.fromkeys(QueryStats.COUNTERS, 0)
+
+	def begin(self, query, queries = 1):
+		"""
+		Starts a record for a query, the traversals add to its counters.
+		"""
+		record = {"query" : query}
+		record.update(QueryStats.counters())
+		record["queries"] = queries
+		record["seconds"] = time.perf_counter()
+		return record
+
+	def end(self, record, hits):
+		"""
+		Finishes a record started by begin and stores it.
+		"""
+		record["hits"] = int(hits)
+		record["seconds"] = time.perf_counter() - record["seconds"]
+		self.records.append(record)
+		if self.callback is not None:
+			self.callback(record)
+
+	@staticmethod
+	def add(record, counters):
+		"""
+		Adds the counters (e.g. of a chunk processed by another thread) to record.
+		"""
+		for name in ("nodes", "leaves", "elements", "contained"):
+			record[name] += counters[name]
+
+	def summary(self):
+		"""
+		Returns per query method the amount of records, and per counter
+		(and seconds) the total, mean, percentiles and a histogram with
+		power of 2 bins.
+
+		:Example:
+		>>> print(stats.summary()["rquery"]["nodes"]["mean"])
+		<<< 23.5
+		"""
+		summary = {}
+		for query in sorted(set(record["query"] for record in self.records)):
+			records = [record for record in self.records if record["query"] == query]
+			summary[query] = {"records" : len(records)}
+			for name in QueryStats.COUNTERS[1:] + ["seconds"]:
+				values = np.array([record[name] for record in records], dtype=np.float64)
+				summary[query][name] = QueryStats.aggregate(values)
+		return summary
+
+	@staticmethod
+	def aggregate(values):
+		"""
+		Internal method that returns the statistics of a set of values.
+		"""
+		positive = values[values > 0]
+		if len(positive) > 0:
+			low, high = np.floor(np.log2(positive.min())), np.ceil(np.log2(positive.max())) + 1
+			edges = np.concatenate(([0], 2.0 ** np.arange(low, high)))
+		else:
+			edges = np.array([0.0, 1.0])
+		counts, edges = np.histogram(values, edges)
+
+		return {"total" : float(values.sum()), "mean" : float(values.mean()),
+				"p50" : float(np.percentile(values, 50)), "p90" : float(np.percentile(values, 90)),
+				"p99" : float(np.percentile(values, 99)), "max" : float(values.max()),
+				"histogram" : {"edges" : edges.tolist(), "counts" : counts.tolist()}}
+
+	def dump(self, path):
+		"""
+		Writes the summary and the records as json.
+
+		:Example:
+		>>> stats.dump("queries.json")
+		"""
+		with open(path, "w") as f:
+			json.dump({"summary" : self.summary(), "records" : list(self.records)}, f, indent=1)
+
+	def clear(self):
+		"""
+		Removes all records
+		"""
+		self.records.clear()
@@ -0,0 +1,118 @@
+import numpy as np
+
+class SecondaryIndex:
+	"""
+	A sorted index on a (non key) field of a Database, answering equality
+	and range lookups in O(log n + result) instead of scanning the column.
+
+	The index is a snapshot of the field's values in sorted order with
+	the corresponding keys. Changes are not merged into the snapshot
+	right away:
+		- records inserted after the snapshot have a key > last_key, they
+		  form the tail of the Database and are checked directly
+		- records changed by update_field are collected as stale keys, their
+		  snapshot entries are ignored and their current values checked
+	once the changes outgrow max(1024, n / 8) the snapshot is rebuilt on
+	the next lookup, so keeping the index up to date costs O(1) per change.
+
+	:Example:
+	>>> db.create_index("quad")
+	>>> print(db.where("quad", "<", 2))
+	<<< [1 4]
+	"""
+	OPERATORS = {
+		"==" : np.equal,
+		"<"  : np.less,
+		"<=" : np.less_equal,
+		">"  : np.greater,
+		">=" : np.greater_equal
+	}
+
+	def __init__(self, db, field):
+		"""
+		Create a new SecondaryIndex instance.
+		:param db	: the Database
+		:param field: the indexed field
+
+		:Example:
+		>>> index = SecondaryIndex(db, "quad")
+		"""
+		self.db = db
+		self.field = field
+		self.build()
+
+	def build(self):
+		"""
+		Internal method that (re)builds the sorted snapshot.
+		"""
+		keys = self.db.keys()
+		values = self.db.column(self.field)
+		order = np.argsort(values, kind="stable")
+
+		self.values = values[order]
+		self.keys = keys[order]
+		self.last_key = self.db.unique_key
+		self.deletions = self.db.deletions
+		self.stale = []
+		self.num_stale = 0
+		self.rebuild = False
+
+	def touch(self, keys):
+		"""
+		Marks the keys whose value changed, called by Database.update_field.
+		"""
+		keys = np.asarray(keys, dtype=np.int64).reshape(-1)
+		keys = keys[keys <= self.last_key]
+		if self.rebuild or len(keys) == 0:
+			return
+
+		self.num_stale += len(keys)
+		if self.num_stale > max(1024, len(self.keys) // 8):
+			self.rebuild = True
+			self.stale = []
+		else:
+			self.stale.append(keys)
+
+	def lookup(self, op, value):
+		"""
+		Returns the keys of the records for which `field op value` holds,
+		deleted records are left out.
+
+		:param op	: one of ==, <, <=, >, >=
+		:param value: the value to compare with
+
+		:Example:
+		>>> print(index.lookup("==", 2))
+		<<< [3 7 9]
+		"""
+		if op not in SecondaryIndex.OPERATORS:
+			raise ValueError('Unsupported operator %s.' % op)
+
+		if self.rebuild:
+			self.build()
+
+		left = np.searchsorted(self.values, value, "left")
+		right = np.searchsorted(self.values, value, "right")
+		lo, hi = {
+			"==" : (left, right),
+			"<"  : (0, left),
+			"<=" : (0, right),
+			">"  : (right, len(self.values)),
+			">=" : (left, len(self.values))
+		}[op]
+		result = self.keys[lo:hi]
+
+		# changed and newly inserted records are checked on their current value
+		changed = self.db.keys_since(self.last_key)
+		if self.num_stale > 0:
+			stale = np.unique(np.concatenate(self.stale))
+			result = result[~np.isin(result, stale)]
+			changed = np.concatenate((self.db.column("key", stale), changed))
+		matches = changed[SecondaryIndex.OPERATORS[op](self.db.column(self.field, changed), value)]
+
+		if len(changed) > max(1024, len(self.keys) // 8):
+			self.rebuild = True
+
+		if self.db.deletions != self.deletions:
+			result = result[self.db.contains(result)]
+		return np.concatenate((result, matches))
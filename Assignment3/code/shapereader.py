@@ -0,0 +1,270 @@
+import mmap
+import os
+import numpy as np
+import boundingbox as bb
+
+class ShapeReader:
+	"""
+	A reader for ESRI shapefiles (.shp with its .shx index) that does not
+	need GDAL. The .shp and .shx files are memory-mapped and the records
+	are decoded in blocks: the offsets of a block are sliced from the
+	index, every value of a block is gathered from the file with a single
+	vectorized step, and the centroids of the shapes are computed per
+	block, so memory use is bounded by the block size.
+
+	supported shape types (with or without Z and M values):
+		point		: the point itself
+		multipoint	: the mean of the points
+		polyline	: the midpoints of the segments weighted by their length
+		polygon		: the area weighted centroid of the rings, holes included
+		null shapes are skipped
+
+	the file layout is described in the ESRI Shapefile Technical Description:
+		header		: 100 bytes, file code 9994 (big endian), shape type and bbox
+		records		: a big endian (number, length) header followed by the
+					  little endian content, the shx file holds the offset
+					  and length of every record (in 16-bit words)
+
+	:Example:
+	>>> with ShapeReader("roads.shp") as shapes:
+	>>>		for block in shapes.blocks(65536):
+	>>>			database.insert_iterable(block)
+	"""
+	POINT = (1, 11, 21)
+	MULTIPOINT = (8, 18, 28)
+	POLYLINE = (3, 13, 23)
+	POLYGON = (5, 15, 25)
+
+	def __init__(self, path):
+		"""
+		Opens a shapefile, the index is the .shx file next to it, when it is
+		missing the records are located by walking the .shp file.
+
+		:param path: the .shp file name
+
+		:Example:
+		>>> shapes = ShapeReader("roads.shp")
+		"""
+		self.path = path
+		with open(path, "rb") as f:
+			self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self.views = {}
+
+		header = np.frombuffer(self.data, dtype=np.uint8, count=100)
+		if header[:4].view(">i4")[0] != 9994:
+			raise ValueError('%s is not a shapefile.' % path)
+		self.shape_type = int(header[32:36].view("<i4")[0])
+		box = header[36:68].view("<f8")
+		self.bbox = bb.BoundingBox(box[0], box[2], box[1], box[3])
+
+		self.index = None
+		stem = os.path.splitext(path)[0]
+		for extension in (".shx", ".SHX"):
+			if os.path.exists(stem + extension):
+				with open(stem + extension, "rb") as f:
+					self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+				break
+
+	def record_offsets(self, size):
+		"""
+		Internal method that lazily yields the byte offsets of the records,
+		size records at a time. The offsets are sliced from the memory-mapped
+		index (8 bytes per record after its 100 byte header), without an
+		index the records are located by walking the .shp file.
+		"""
+		if self.index is not None:
+			count = (len(self.index) - 100) // 8
+			for start in range(0, count, size):
+				yield np.frombuffer(self.index, ">i4", 2 * min(size, count - start), 100 + 8 * start)[0::2].astype(np.int64) * 2
+			return
+
+		offsets = []
+		offset = 100
+		end = min(len(self.data), int(np.frombuffer(self.data, ">i4", 1, 24)[0]) * 2)
+		while offset + 8 <= end:
+			offsets.append(offset)
+			offset += 8 + int(np.frombuffer(self.data, ">i4", 1, offset + 4)[0]) * 2
+			if len(offsets) == size:
+				yield np.array(offsets, dtype=np.int64)
+				offsets = []
+		if len(offsets) > 0:
+			yield np.array(offsets, dtype=np.int64)
+
+	def __len__(self):
+		"""
+		Returns the amount of records (null shapes included), without an
+		index this walks the .shp file.
+		"""
+		if self.index is not None:
+			return (len(self.index) - 100) // 8
+		return sum(len(offsets) for offsets in self.record_offsets(65536))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		"""
+		Closes the memory maps
+		"""
+		self.views = {}
+		self.data.close()
+		if self.index is not None:
+			self.index.close()
+
+	def gather(self, offsets, dtype):
+		"""
+		Internal method that reads the (little endian) values of dtype at the
+		given byte offsets. The file is viewed as an array of dtype once for
+		every possible misalignment, every value is then a plain index in the
+		view matching its offset.
+		"""
+		dtype = np.dtype(dtype)
+		shift = offsets % dtype.itemsize
+		values = np.empty(len(offsets), dtype)
+		for s in np.unique(shift):
+			if (dtype, s) not in self.views:
+				count = (len(self.data) - s) // dtype.itemsize
+				self.views[dtype, s] = np.frombuffer(self.data, dtype, count, s)
+			selected = shift == s
+			values[selected] = self.views[dtype, s][(offsets[selected] - s) // dtype.itemsize]
+		return values
+
+	def blocks(self, size = 65536):
+		"""
+		Lazily yields the centroids of the shapes as (n, 2) numpy arrays, one
+		per block of size records (null shapes are left out). Only one block
+		is decoded at a time, the pages of the memory map are loaded on demand,
+		so files larger than the memory can be read.
+
+		:param size: the amount of records per block
+
+		:Example:
+		>>> for block in shapes.blocks(1024):
+		>>>		print(block.shape)
+		<<< (1024, 2)
+		"""
+		for offsets in self.record_offsets(size):
+			yield self.centroids_block(offsets)
+
+	def centroids(self):
+		"""
+		Returns the centroids of all the shapes as a (n, 2) numpy array.
+
+		:Example:
+		>>> print(shapes.centroids()[:2])
+		<<< [[6.5 52.1]
+			 [6.6 52.3]]
+		"""
+		return np.concatenate(list(self.blocks()) + [np.empty((0, 2))])
+
+	def centroids_block(self, records):
+		"""
+		Internal method that returns the centroids of the records starting at
+		the given byte offsets, the content starts after the 8 byte header.
+		"""
+		content = records + 8
+		types = self.gather(content, "<i4")
+		centroids = np.full((len(records), 2), np.nan)
+
+		points = np.isin(types, ShapeReader.POINT)
+		centroids[points, 0] = self.gather(content[points] + 4, "<f8")
+		centroids[points, 1] = self.gather(content[points] + 12, "<f8")
+
+		# multipoints: box (32 bytes), count, points
+		selected = np.isin(types, ShapeReader.MULTIPOINT)
+		counts = self.gather(content[selected] + 36, "<i4").astype(np.int64)
+		record, x, y = self.vertices(content[selected] + 40, counts)
+		centroids[selected] = ShapeReader.mean(record, x, y, len(counts))
+
+		# polylines and polygons: box (32 bytes), part count, point count, parts, points
+		for shapes, centroid in ((ShapeReader.POLYLINE, ShapeReader.line_centroids), (ShapeReader.POLYGON, ShapeReader.polygon_centroids)):
+			selected = np.isin(types, shapes)
+			parts = self.gather(content[selected] + 36, "<i4").astype(np.int64)
+			counts = self.gather(content[selected] + 40, "<i4").astype(np.int64)
+			record, x, y = self.vertices(content[selected] + 44 + 4 * parts, counts)
+
+			# mark the first vertex of every part
+			part_record = np.repeat(np.arange(len(parts)), parts)
+			part_offsets = np.repeat(content[selected] + 44, parts) + 4 * ShapeReader.local_index(parts)
+			first = np.concatenate(([0], np.cumsum(counts)[:-1]))[part_record] + self.gather(part_offsets, "<i4")
+			starts = np.zeros(len(x), dtype=bool)
+			starts[first[first < len(x)]] = True
+
+			centroids[selected] = centroid(record, x, y, starts, len(parts))
+
+		return centroids[~np.isnan(centroids[:, 0])]
+
+	def vertices(self, offsets, counts):
+		"""
+		Internal method that reads counts[i] (x, y) points starting at byte
+		offsets[i], returns the record of every point and their x and y.
+		"""
+		record = np.repeat(np.arange(len(counts)), counts)
+		positions = offsets[record] + 16 * ShapeReader.local_index(counts)
+		return record, self.gather(positions, "<f8"), self.gather(positions + 8, "<f8")
+
+	@staticmethod
+	def local_index(counts):
+		"""
+		Internal method that returns 0..counts[i]-1 for every i, concatenated.
+		"""
+		total = int(np.sum(counts))
+		return np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+
+	@staticmethod
+	def mean(record, x, y, n):
+		"""
+		Internal method that returns the mean point per record.
+		"""
+		count = np.bincount(record, minlength=n)
+		with np.errstate(invalid="ignore", divide="ignore"):
+			return np.column_stack((np.bincount(record, x, n) / count, np.bincount(record, y, n) / count))
+
+	@staticmethod
+	def line_centroids(record, x, y, starts, n):
+		"""
+		Internal method that returns the centroid of every polyline, the
+		midpoints of the segments weighted by their length. Segments do not
+		cross parts. Lines without length use the mean of their points.
+		"""
+		segment = ~starts[1:]
+		length = np.hypot(x[1:] - x[:-1], y[1:] - y[:-1]) * segment
+		owner = record[1:]
+		total = np.bincount(owner, length, n)
+		with np.errstate(invalid="ignore", divide="ignore"):
+			centroids = np.column_stack((np.bincount(owner, length * (x[1:] + x[:-1]) / 2, n) / total,
+										 np.bincount(owner, length * (y[1:] + y[:-1]) / 2, n) / total))
+		degenerate = ~(total > 0)
+		centroids[degenerate] = ShapeReader.mean(record, x, y, n)[degenerate]
+		return centroids
+
+	@staticmethod
+	def polygon_centroids(record, x, y, starts, n):
+		"""
+		Internal method that returns the centroid of every polygon with the
+		shoelace formula over all its rings. Outer rings are clockwise and
+		holes counter clockwise, so the signed areas of holes are subtracted.
+		Polygons without area use the mean of their points.
+		"""
+		segment = ~starts[1:]
+		cross = (x[:-1] * y[1:] - x[1:] * y[:-1]) * segment
+		owner = record[1:]
+		area = np.bincount(owner, cross, n)
+		with np.errstate(invalid="ignore", divide="ignore"):
+			centroids = np.column_stack((np.bincount(owner, cross * (x[:-1] + x[1:]), n) / (3 * area),
+										 np.bincount(owner, cross * (y[:-1] + y[1:]), n) / (3 * area)))
+		degenerate = ~(area != 0)
+		centroids[degenerate] = ShapeReader.mean(record, x, y, n)[degenerate]
+		return centroids
+
+if __name__ == '__main__':
+	import sys
+
+	with ShapeReader(sys.argv[1]) as shapes:
+		print(len(shapes), shapes.shape_type, shapes.bbox)
+		for block in shapes.blocks(4):
+			print(block)
+			break